@@ -0,0 +1,150 @@
+import json
+import uuid
+import base64
+import locale
+import time
+import asyncio
+import threading
+from datetime import datetime
+
+# Created here so that it is consistent
+USER_ID = uuid.uuid4()
+DEVICE_ID = uuid.uuid4()
+
+ANISETTE_URL = 'http://localhost:6969'  # https://github.com/Dadoum/anisette-v3-server
+
+# Shortest pause between two background refreshes in prefetch()
+PREFETCH_MIN_INTERVAL = 1
+
+
+class AnisetteProvider:
+    """Anisette header provider.
+
+    The pyprovision ADI/Device state is loaded once and reused. Headers from
+    get() are cached for `ttl` seconds and can be refreshed in the background
+    by prefetch() shortly before they expire. Without pyprovision, a pool of
+    anisette servers is used, failing over to the next one on
+    errors and staying on the last one that worked.
+    """
+
+    def __init__(self, urls=None, ttl=30, refresh_margin=5):
+        self.urls = list(urls or [ANISETTE_URL])
+        self.ttl = ttl
+        # Refreshing earlier than half the ttl would keep prefetch() busy regenerating
+        self.refresh_margin = min(refresh_margin, ttl / 2)
+        self._adi = None
+        self._dsid = None
+        self._next_url = 0
+        self._headers = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def _load_adi(self):
+        if self._adi is not None:
+            return self._adi
+        try:
+            import pyprovision
+            from ctypes import c_ulonglong
+            import secrets
+        except ImportError:
+            print(f'pyprovision is not installed, querying {", ".join(self.urls)} for an anisette server')
+            self._adi = False
+            return self._adi
+        adi = pyprovision.ADI("./anisette/")
+        adi.provisioning_path = "./anisette/"
+        device = pyprovision.Device("./anisette/device.json")
+        if not device.initialized:
+            # Pretend to be a MacBook Pro
+            device.server_friendly_description = "<MacBookPro13,2> <macOS;13.1;22C65> <com.apple.AuthKit/1 (com.apple.dt.Xcode/3594.4.19)>"
+            device.unique_device_identifier = str(uuid.uuid4()).upper()
+            device.adi_identifier = secrets.token_hex(8).lower()
+            device.local_user_uuid = secrets.token_hex(32).upper()
+        adi.identifier = device.adi_identifier
+        dsid = c_ulonglong(-2).value
+        is_prov = adi.is_machine_provisioned(dsid)
+        if not is_prov:
+            print("provisioning...")
+            provisioning_session = pyprovision.ProvisioningSession(adi, device)
+            provisioning_session.provision(dsid)
+        self._adi = adi
+        self._dsid = dsid
+        return self._adi
+
+    def _query_servers(self):
+        # requests is only imported once a server is actually queried
+        import requests
+        error = None
+        for _ in range(len(self.urls)):
+            url = self.urls[self._next_url]
+            try:
+                h = json.loads(requests.get(url, timeout=5).text)
+                return {"X-Apple-I-MD": h["X-Apple-I-MD"], "X-Apple-I-MD-M": h["X-Apple-I-MD-M"]}
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                print(f'Anisette server {url} failed: {e}')
+                error = e
+                # Stick with a working server, move on to the next one on failure
+                self._next_url = (self._next_url + 1) % len(self.urls)
+        raise error
+
+    def generate(self):
+        """Generate a fresh set of headers, bypassing the cache"""
+        adi = self._load_adi()
+        if adi:
+            otp = adi.request_otp(self._dsid)
+            a = {"X-Apple-I-MD": base64.b64encode(bytes(otp.one_time_password)).decode(), "X-Apple-I-MD-M": base64.b64encode(bytes(otp.machine_identifier)).decode()}
+        else:
+            a = self._query_servers()
+        a.update(generate_meta_headers(user_id=USER_ID, device_id=DEVICE_ID))
+        return a
+
+    def get(self):
+        """Return cached headers, regenerating them once they expire"""
+        with self._lock:
+            if self._headers is None or time.monotonic() >= self._expires:
+                self._refresh()
+            return dict(self._headers)
+
+    def _refresh(self):
+        self._headers = self.generate()
+        self._expires = time.monotonic() + self.ttl
+
+    async def get_async(self):
+        """Like get(), but never blocks the event loop on a refresh"""
+        if self._headers is not None and time.monotonic() < self._expires:
+            return dict(self._headers)
+        return await asyncio.to_thread(self.get)
+
+    async def prefetch(self):
+        """Refresh the cached headers shortly before they expire, until cancelled"""
+        while True:
+            delay = self._expires - self.refresh_margin - time.monotonic()
+            # Never refresh more than once a second, even with a tiny ttl
+            await asyncio.sleep(max(delay, PREFETCH_MIN_INTERVAL))
+            try:
+                await asyncio.to_thread(self._locked_refresh)
+            except Exception as e:
+                print(f'Anisette prefetch failed: {e}')
+                await asyncio.sleep(max(self.refresh_margin, PREFETCH_MIN_INTERVAL))
+
+    def _locked_refresh(self):
+        with self._lock:
+            self._refresh()
+
+
+_default_provider = AnisetteProvider()
+
+
+def generate_anisette_headers():
+    return _default_provider.generate()
+
+def generate_meta_headers(serial="0", user_id=uuid.uuid4(), device_id=uuid.uuid4()):
+    return {
+        "X-Apple-I-Client-Time": datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
+        "X-Apple-I-TimeZone": str(datetime.utcnow().astimezone().tzinfo),
+        "loc": locale.getdefaultlocale()[0] or "en_US",
+        "X-Apple-Locale": locale.getdefaultlocale()[0] or "en_US",
+        "X-Apple-I-MD-RINFO": "17106176",  # either 17106176 or 50660608
+        "X-Apple-I-MD-LU": base64.b64encode(str(user_id).upper().encode()).decode(),
+        "X-Mme-Device-Id": str(device_id).upper(),
+        "X-Apple-I-SRL-NO": serial,  # Serial number
+    }
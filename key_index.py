@@ -0,0 +1,257 @@
+import os
+import glob
+import json
+import mmap
+import base64
+import hashlib
+import struct
+from collections.abc import Mapping
+
+# 每个 .keys 文件对应一个分段：按文件顺序存放 (hashed adv key, 私钥)
+SEGMENT_RECORD = struct.Struct('<32s28s')
+# 合并索引：记录按 (设备, 密钥序号) 排序，另附按哈希排序的记录号和 16 位前缀桶表
+INDEX_HEADER = struct.Struct('<4sII')
+INDEX_RECORD = struct.Struct('<32s28sII')
+INDEX_MAGIC = b'NJKI'
+INDEX_VERSION = 1
+BUCKETS = 1 << 16
+
+
+def parse_keyfile(keyfile):
+    """解析 generate_keys.py 生成的 .keys 文本文件，返回 [(私钥, hashed adv key)]"""
+    pairs = []
+    with open(keyfile) as f:
+        current_priv = None
+        current_hashed_adv = None
+        current_adv = None
+
+        for line in f:
+            key = line.rstrip('\n').split(': ')
+            if key[0] == 'Private key':
+                current_priv = key[1]
+            elif key[0] == 'Advertisement key':
+                current_adv = key[1]
+            elif key[0] == 'Hashed adv key':
+                current_hashed_adv = key[1]
+
+            # When we have a complete key set, store it
+            if current_priv and current_adv and current_hashed_adv:
+                pairs.append((current_priv, current_hashed_adv))
+
+                # Reset for next key pair
+                current_priv = current_adv = current_hashed_adv = None
+    return pairs
+
+
+class KeyIndex:
+    """编译后的密钥索引
+
+    .keys 文本只在文件 mtime/大小变化时重新解析，结果写入二进制分段；
+    分段变化时再合并成一个内存映射的索引文件，按 hashed adv key 的前 16 位分桶查找。
+    privkeys 和 names 是只读映射，用法与原来的字典相同。
+    """
+
+    def __init__(self, keys_dir, prefix=''):
+        self.keys_dir = keys_dir
+        self.prefix = prefix
+        self.index_dir = os.path.join(keys_dir, '.keyindex')
+        self.manifest_path = os.path.join(self.index_dir, 'manifest.json')
+        self.index_path = os.path.join(self.index_dir, 'keys.idx')
+        self._file = None
+        self._map = b''
+        self.count = 0
+
+        os.makedirs(os.path.join(self.index_dir, 'segments'), exist_ok=True)
+        manifest, changed = self._refresh_segments()
+        if changed or not os.path.exists(self.index_path):
+            self._build_index(manifest)
+            # 索引替换成功后才写入清单；中途退出时旧清单与新分段不一致，下次会重新合并
+            self._write_manifest(manifest)
+        self._open_index(manifest)
+
+        self.privkeys = _PrivateKeys(self)
+        self.names = _Names(self)
+
+    def _refresh_segments(self):
+        """只重新解析新增或修改过的 .keys 文件"""
+        try:
+            with open(self.manifest_path) as f:
+                old = json.load(f)
+        except (FileNotFoundError, ValueError):
+            old = {"files": {}}
+
+        files = {}
+        changed = False
+        keyfiles = sorted(glob.glob(os.path.join(self.keys_dir, '**', '*.keys'), recursive=True))
+        for keyfile in keyfiles:
+            relpath = os.path.relpath(keyfile, self.keys_dir)
+            stat = os.stat(keyfile)
+            entry = old["files"].get(relpath)
+            segment = hashlib.sha1(relpath.encode()).hexdigest() + '.seg'
+            segment_path = os.path.join(self.index_dir, 'segments', segment)
+            if (entry and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size
+                    and os.path.exists(segment_path)):
+                files[relpath] = entry
+                continue
+
+            pairs = parse_keyfile(keyfile)
+            with open(f'{segment_path}.{os.getpid()}.tmp', 'wb') as f:
+                for priv, hashed_adv in pairs:
+                    f.write(SEGMENT_RECORD.pack(base64.b64decode(hashed_adv), base64.b64decode(priv)))
+            os.replace(f'{segment_path}.{os.getpid()}.tmp', segment_path)
+            files[relpath] = {"mtime": stat.st_mtime_ns, "size": stat.st_size,
+                              "segment": segment, "count": len(pairs)}
+            changed = True
+
+        # 删除已不存在的 .keys 文件的分段
+        for relpath, entry in old["files"].items():
+            if relpath not in files:
+                changed = True
+                try:
+                    os.remove(os.path.join(self.index_dir, 'segments', entry["segment"]))
+                except FileNotFoundError:
+                    pass
+
+        return {"files": files}, changed
+
+    def _write_manifest(self, manifest):
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _build_index(self, manifest):
+        """把所有分段合并成一个索引文件"""
+        records = []
+        for device, entry in enumerate(manifest["files"].values()):
+            with open(os.path.join(self.index_dir, 'segments', entry["segment"]), 'rb') as f:
+                data = f.read()
+            for key_index, (hashed_adv, priv) in enumerate(SEGMENT_RECORD.iter_unpack(data)):
+                records.append((hashed_adv, priv, device, key_index))
+
+        by_hash = sorted(range(len(records)), key=lambda i: records[i][0])
+        buckets = [0] * (BUCKETS + 1)
+        for i in by_hash:
+            buckets[int.from_bytes(records[i][0][:2], 'big') + 1] += 1
+        for b in range(BUCKETS):
+            buckets[b + 1] += buckets[b]
+
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(records)))
+            for record in records:
+                f.write(INDEX_RECORD.pack(*record))
+            f.write(struct.pack(f'<{len(by_hash)}I', *by_hash))
+            f.write(struct.pack(f'<{BUCKETS + 1}I', *buckets))
+        os.replace(tmp_path, self.index_path)
+
+    def _open_index(self, manifest):
+        self._file = open(self.index_path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count = INDEX_HEADER.unpack_from(self._map, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"Invalid key index {self.index_path}")
+        self._records_at = INDEX_HEADER.size
+        self._order_at = self._records_at + self.count * INDEX_RECORD.size
+        self._buckets_at = self._order_at + self.count * 4
+
+        # 设备名为文件名去掉 .keys 后缀和前缀，只保留匹配前缀的设备
+        self.devices = []
+        for relpath, entry in manifest["files"].items():
+            base = os.path.basename(relpath)[:-5]
+            if base.startswith(self.prefix):
+                self.devices.append(base[len(self.prefix):])
+            else:
+                self.devices.append(None)
+            if entry["count"] == 0 and base.startswith(self.prefix):
+                print(f"Couldn't find valid key pair in {os.path.join(self.keys_dir, relpath)}")
+        self.size = sum(entry["count"] for entry, device in zip(manifest["files"].values(), self.devices)
+                        if device is not None)
+
+    def _record(self, i):
+        return INDEX_RECORD.unpack_from(self._map, self._records_at + i * INDEX_RECORD.size)
+
+    def find(self, id):
+        """按 hashed adv key 查找记录，返回 (私钥字节, 设备名) 或 None"""
+        try:
+            hashed_adv = base64.b64decode(id)
+        except (ValueError, TypeError):
+            return None
+        if len(hashed_adv) != 32:
+            return None
+        bucket = int.from_bytes(hashed_adv[:2], 'big')
+        start, end = struct.unpack_from('<2I', self._map, self._buckets_at + bucket * 4)
+        for pos in range(start, end):
+            i = struct.unpack_from('<I', self._map, self._order_at + pos * 4)[0]
+            record_hash, priv, device, _ = self._record(i)
+            if record_hash == hashed_adv:
+                if self.devices[device] is None:
+                    return None
+                return priv, self.devices[device]
+        return None
+
+    def records(self):
+        """按设备、密钥序号的顺序批量遍历 (hashed adv key, 设备名, 密钥序号)，不经过逐条查找"""
+        devices = self.devices
+        b64encode = base64.b64encode
+        view = memoryview(self._map)[self._records_at:self._order_at]
+        try:
+            for hashed_adv, _, device, key_index in INDEX_RECORD.iter_unpack(view):
+                name = devices[device]
+                if name is not None:
+                    yield b64encode(hashed_adv).decode('ascii'), name, key_index
+        finally:
+            view.release()
+
+    def __iter__(self):
+        """按设备、密钥序号的顺序遍历 hashed adv key"""
+        for id, _, _ in self.records():
+            yield id
+
+    def close(self):
+        if self._file is not None:
+            self._map.close()
+            self._file.close()
+            self._file = None
+
+
+class _PrivateKeys(Mapping):
+    """hashed adv key -> base64 私钥"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, id):
+        found = self.index.find(id)
+        if found is None:
+            raise KeyError(id)
+        return base64.b64encode(found[0]).decode('ascii')
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return self.index.size
+
+
+class _Names(Mapping):
+    """hashed adv key -> 设备名"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, id):
+        found = self.index.find(id)
+        if found is None:
+            raise KeyError(id)
+        return found[1]
+
+    def items(self):
+        # 批量读取记录，避免对每个 key 调用 __getitem__
+        return ((id, name) for id, name, _ in self.index.records())
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return self.index.size
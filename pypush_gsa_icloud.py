@@ -1,22 +1,16 @@
 from getpass import getpass
 import plistlib as plist
-import json
-import uuid
 import pbkdf2
 import requests
 import hashlib
 import hmac
 import base64
-import locale
-from datetime import datetime
 import srp._pysrp as srp
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from Crypto.Hash import SHA256
-
-# Created here so that it is consistent
-USER_ID = uuid.uuid4()
-DEVICE_ID = uuid.uuid4()
+# Anisette headers live in their own module so fetching does not need the login stack
+from anisette import USER_ID, DEVICE_ID, ANISETTE_URL, AnisetteProvider, generate_anisette_headers, generate_meta_headers
 
 # Configure SRP library for compatibility with Apple's implementation
 srp.rfc5054_enable()
@@ -26,8 +20,6 @@ srp.no_username_in_x()
 import urllib3
 urllib3.disable_warnings()
 
-ANISETTE_URL = 'http://localhost:6969'  # https://github.com/Dadoum/anisette-v3-server
-
 def icloud_login_mobileme(username='', password='', second_factor='sms'):
     if not username:
         username = input('Apple ID: ')
@@ -154,48 +146,6 @@ def generate_cpd():
     cpd.update(generate_anisette_headers())
     return cpd
 
-def generate_anisette_headers():
-    try:
-        import pyprovision
-        from ctypes import c_ulonglong
-        import secrets
-        adi = pyprovision.ADI("./anisette/")
-        adi.provisioning_path = "./anisette/"
-        device = pyprovision.Device("./anisette/device.json")
-        if not device.initialized:
-            # Pretend to be a MacBook Pro
-            device.server_friendly_description = "<MacBookPro13,2> <macOS;13.1;22C65> <com.apple.AuthKit/1 (com.apple.dt.Xcode/3594.4.19)>"
-            device.unique_device_identifier = str(uuid.uuid4()).upper()
-            device.adi_identifier = secrets.token_hex(8).lower()
-            device.local_user_uuid = secrets.token_hex(32).upper()
-        adi.identifier = device.adi_identifier
-        dsid = c_ulonglong(-2).value
-        is_prov = adi.is_machine_provisioned(dsid)
-        if not is_prov:
-            print("provisioning...")
-            provisioning_session = pyprovision.ProvisioningSession(adi, device)
-            provisioning_session.provision(dsid)
-        otp = adi.request_otp(dsid)
-        a = {"X-Apple-I-MD": base64.b64encode(bytes(otp.one_time_password)).decode(), "X-Apple-I-MD-M": base64.b64encode(bytes(otp.machine_identifier)).decode()}
-    except ImportError:
-        print(f'pyprovision is not installed, querying {ANISETTE_URL} for an anisette server')
-        h = json.loads(requests.get(ANISETTE_URL, timeout=5).text)
-        a = {"X-Apple-I-MD": h["X-Apple-I-MD"], "X-Apple-I-MD-M": h["X-Apple-I-MD-M"]}
-    a.update(generate_meta_headers(user_id=USER_ID, device_id=DEVICE_ID))
-    return a
-
-def generate_meta_headers(serial="0", user_id=uuid.uuid4(), device_id=uuid.uuid4()):
-    return {
-        "X-Apple-I-Client-Time": datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
-        "X-Apple-I-TimeZone": str(datetime.utcnow().astimezone().tzinfo),
-        "loc": locale.getdefaultlocale()[0] or "en_US",
-        "X-Apple-Locale": locale.getdefaultlocale()[0] or "en_US",
-        "X-Apple-I-MD-RINFO": "17106176",  # either 17106176 or 50660608
-        "X-Apple-I-MD-LU": base64.b64encode(str(user_id).upper().encode()).decode(),
-        "X-Mme-Device-Id": str(device_id).upper(),
-        "X-Apple-I-SRL-NO": serial,  # Serial number
-    }
-
 def encrypt_password(password, salt, iterations):
     p = hashlib.sha256(password.encode("utf-8")).digest()
     return pbkdf2.PBKDF2(p, salt, iterations, SHA256).read(32)
@@ -0,0 +1,178 @@
+import os
+import base64
+import hashlib
+import struct
+import asyncio
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.backends import default_backend
+
+
+def sha256(data):
+    digest = hashlib.new("sha256")
+    digest.update(data)
+    return digest.digest()
+
+
+def decrypt(enc_data, algorithm_dkey, mode):
+    decryptor = Cipher(algorithm_dkey, mode, default_backend()).decryptor()
+    return decryptor.update(enc_data) + decryptor.finalize()
+
+
+def decode_tag(data):
+    latitude = struct.unpack(">i", data[0:4])[0] / 10000000.0
+    longitude = struct.unpack(">i", data[4:8])[0] / 10000000.0
+    confidence = int.from_bytes(data[8:9], 'big')
+    status = int.from_bytes(data[9:10], 'big')
+    return {'lat': latitude, 'lon': longitude, 'conf': confidence, 'status': status}
+
+
+class PrivateKeyCache:
+    """已派生私钥对象的 LRU 缓存，按 hashed adv key 索引"""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+
+    def get(self, key_id, privkey):
+        key = self._keys.get(key_id)
+        if key is not None:
+            self._keys.move_to_end(key_id)
+            return key
+
+        priv = int.from_bytes(base64.b64decode(privkey), 'big')
+        key = ec.derive_private_key(priv, ec.SECP224R1(), default_backend())
+        if self.maxsize > 0:
+            self._keys[key_id] = key
+            if len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)  # 淘汰最久未使用的私钥
+        return key
+
+    def __len__(self):
+        return len(self._keys)
+
+
+# 每个进程各自持有一份缓存，生命周期与解密引擎一致
+_key_cache = PrivateKeyCache()
+
+
+def init_key_cache(maxsize):
+    """重建当前进程的私钥缓存，也用作进程池的 initializer"""
+    global _key_cache
+    _key_cache = PrivateKeyCache(maxsize)
+
+
+def payload_timestamp(payload):
+    """读取报告载荷开头的时间戳（Unix 秒），不需要解密"""
+    return int.from_bytes(base64.b64decode(payload[:8])[0:4], 'big') + 978307200
+
+
+def decrypt_payload(privkey, payload, startdate=0, key_id=None):
+    """解密单条报告载荷，早于 startdate 的报告返回 None"""
+    data = base64.b64decode(payload)
+    if len(data) > 88:
+        data = data[:4] + data[5:]
+
+    timestamp = int.from_bytes(data[0:4], 'big') + 978307200
+    if timestamp < startdate:
+        return None
+
+    eph_key = ec.EllipticCurvePublicKey.from_encoded_point(
+        ec.SECP224R1(), data[5:62])
+    shared_key = _key_cache.get(key_id or privkey, privkey).exchange(
+        ec.ECDH(), eph_key)
+    symmetric_key = sha256(
+        shared_key + b'\x00\x00\x00\x01' + data[5:62])
+    decryption_key = symmetric_key[:16]
+    iv = symmetric_key[16:]
+    enc_data = data[62:72]
+    tag = data[72:]
+
+    decrypted = decrypt(enc_data, algorithms.AES(
+        decryption_key), modes.GCM(iv, tag))
+    tag = decode_tag(decrypted)
+    tag['timestamp'] = timestamp
+    return tag
+
+
+def decrypt_chunk(items, startdate=0):
+    """解密一批 (私钥, 载荷[, hashed adv key])，单条失败不影响整批，失败项返回 None"""
+    tags = []
+    for privkey, payload, *key_id in items:
+        try:
+            tags.append(decrypt_payload(privkey, payload, startdate, *key_id))
+        except Exception as e:
+            print(f"解密失败: {e}")
+            tags.append(None)
+    return tags
+
+
+class DecryptionEngine:
+    """进程池解密引擎，按批次把 (私钥, 载荷) 分发到多个进程，结果保持输入顺序
+
+    每个进程缓存派生好的私钥对象，缓存随引擎创建而重建；
+    常驻进程复用同一个引擎即可跨轮次保留缓存。
+    """
+
+    def __init__(self, workers=None, chunk_size=256, key_cache_size=4096):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = max(1, chunk_size)
+        self.key_cache_size = key_cache_size
+        self._pool = None
+        init_key_cache(key_cache_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            # 进程池在事件循环中才创建，此时进程中可能已有其他线程（如 aiohttp 的 DNS 解析线程）；
+            # 不能直接 fork 多线程进程，改用 forkserver（不支持的平台用 spawn）启动子进程
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=init_key_cache,
+                initargs=(self.key_cache_size,)
+            )
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _chunks(self, items):
+        items = list(items)
+        return [items[i:i + self.chunk_size] for i in range(0, len(items), self.chunk_size)]
+
+    def decrypt_many(self, items, startdate=0):
+        """同步解密，返回与 items 顺序一致的结果列表"""
+        chunks = self._chunks(items)
+        # 单进程或只有一批时直接在当前进程解密，省去进程间传输
+        if self.workers <= 1 or len(chunks) <= 1:
+            return [tag for chunk in chunks for tag in decrypt_chunk(chunk, startdate)]
+        results = self.pool.map(decrypt_chunk, chunks, [startdate] * len(chunks))
+        return [tag for tags in results for tag in tags]
+
+    async def decrypt_many_async(self, items, startdate=0):
+        """异步解密，不阻塞事件循环，返回与 items 顺序一致的结果列表"""
+        chunks = self._chunks(items)
+        if not chunks:
+            return []
+        if self.workers <= 1:
+            return [tag for chunk in chunks for tag in decrypt_chunk(chunk, startdate)]
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(
+            loop.run_in_executor(self.pool, decrypt_chunk, chunk, startdate)
+            for chunk in chunks
+        ))
+        return [tag for tags in results for tag in tags]
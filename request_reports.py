@@ -1,92 +1,492 @@
 #!/usr/bin/env python3
+import time
+# 记录导入开始时间，供 --profile-startup 统计导入耗时
+IMPORT_START = time.perf_counter()
 import os
-import glob
 import datetime
 import argparse
 import base64
 import json
 import hashlib
-import struct
+import math
+import random
+import socket
+import email.utils
 import asyncio
 import aiohttp
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.backends import default_backend
 import sqlite3
-import requests
-import time
-from pypush_gsa_icloud import icloud_login_mobileme, generate_anisette_headers
-
+import sys
+from anisette import AnisetteProvider
+from report_decryptor import DecryptionEngine, payload_timestamp
+from key_index import KeyIndex
+# pypush_gsa_icloud（srp、pbkdf2、pycryptodome、requests 等）只在需要登录时才导入
+IMPORT_END = time.perf_counter()
 
-def sha256(data):
-    digest = hashlib.new("sha256")
-    digest.update(data)
-    return digest.digest()
 
-
-def decrypt(enc_data, algorithm_dkey, mode):
-    decryptor = Cipher(algorithm_dkey, mode, default_backend()).decryptor()
-    return decryptor.update(enc_data) + decryptor.finalize()
+def build_report_data(report, tag, name):
+    """补全解密结果并生成上传到服务器的报告数据"""
+    tag['isodatetime'] = datetime.datetime.fromtimestamp(
+        tag['timestamp']).isoformat()
+    tag['key'] = name
+    tag['goog'] = 'https://maps.google.com/maps?q=' + \
+        str(tag['lat']) + ',' + str(tag['lon'])
+    return {
+        'id_short': name,
+        'timestamp': tag['timestamp'],
+        'isodatetime': tag['isodatetime'],
+        'datePublished': report['datePublished'],
+        'latitude': tag['lat'],
+        'longitude': tag['lon'],
+        'payload': report['payload'],
+        'id': report['id'],
+        'status': tag['status'],
+        'statusCode': report['statusCode']
+    }
 
 
-def decode_tag(data):
-    latitude = struct.unpack(">i", data[0:4])[0] / 10000000.0
-    longitude = struct.unpack(">i", data[4:8])[0] / 10000000.0
-    confidence = int.from_bytes(data[8:9], 'big')
-    status = int.from_bytes(data[9:10], 'big')
-    return {'lat': latitude, 'lon': longitude, 'conf': confidence, 'status': status}
+DEFAULT_CONFIG = {
+    "server_url": "http://localhost:3001",
+    "api_endpoint": "/api/reports",
+    "batch_endpoint": "/api/reports/batch",
+    "upload_batch_size": 200,
+    "upload_concurrency": 4,
+    "timeout": 30,
+    "retry_attempts": 3,
+    "queue_size": 64,
+    "key_cache_size": 4096,
+    "outbox_path": "outbox.db",
+    "watermark_path": "watermarks.db",
+    "watermark_overlap": 600,
+    "seen_path": "seen.db",
+    "seen_max_entries": 200000,
+    "poll_min_interval": 300,
+    "poll_max_interval": 3600,
+    "poll_backoff": 2.0,
+    "poll_max_keys": 500,
+    "poll_tick": 30,
+    "anisette_urls": [],
+    "anisette_ttl": 30,
+    "fetch_concurrency": 100,
+    "fetch_initial_concurrency": 16,
+    "fetch_target_latency": 5,
+    "fetch_retry_attempts": 3,
+    "auth_profiles": ["auth.json"],
+    "lease_endpoint": "/api/leases",
+    "lease_shards": 64,
+    "lease_ttl": 120,
+    "lease_settle": 5,
+    "rotation_path": "rotation.db",
+    "rotation_period": 0,
+    "rotation_periods": {},
+    "rotation_slack": 2,
+    "rotation_resync_periods": 96
+}
 
 
 def load_config():
-    """加载配置文件"""
+    """加载配置文件，缺失的配置项使用默认值"""
     config_path = os.path.dirname(os.path.realpath(__file__)) + "/config.json"
+    config = dict(DEFAULT_CONFIG)
     try:
         with open(config_path, "r") as f:
-            return json.load(f)
+            config.update(json.load(f))
     except FileNotFoundError:
         print(f"配置文件 {config_path} 不存在，使用默认配置")
-        return {
-            "server_url": "http://localhost:3001",
-            "api_endpoint": "/api/reports",
-            "timeout": 30,
-            "retry_attempts": 3
-        }
-
-
-def send_report_to_server(report_data, config):
-    """发送报告数据到远程服务器"""
-    url = config["server_url"] + config["api_endpoint"]
-    
-    for attempt in range(config["retry_attempts"]):
-        try:
-            response = requests.post(
-                url,
-                json=report_data,
-                timeout=config["timeout"],
-                headers={"Content-Type": "application/json"}
-            )
-            if response.status_code == 200:
-                print(f"成功发送报告到服务器: {report_data.get('id_short', 'unknown')}")
-                return True
+    return config
+
+
+class ReportUploader:
+    """异步上传器：复用连接池，限制同时在途的上传请求数"""
+
+    def __init__(self, config):
+        self.config = config
+        self.window = asyncio.Semaphore(config["upload_concurrency"])
+        self.session = None
+        self.tasks = set()
+        self.failed = []
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.config["upload_concurrency"]),
+            timeout=aiohttp.ClientTimeout(total=self.config["timeout"])
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.drain()
+        await self.session.close()
+
+    async def send_report(self, report_data):
+        """发送单条报告数据到远程服务器，返回 False 表示需要稍后重发"""
+        url = self.config["server_url"] + self.config["api_endpoint"]
+        retry_attempts = self.config["retry_attempts"]
+
+        for attempt in range(retry_attempts):
+            try:
+                async with self.session.post(url, json=report_data) as response:
+                    if response.status == 200:
+                        print(f"成功发送报告到服务器: {report_data.get('id_short', 'unknown')}")
+                        return True
+                    elif response.status == 400:
+                        # 报告本身不合法，重发也不会成功，直接丢弃
+                        print(f"服务器拒绝报告 {report_data.get('id_short', 'unknown')}，已丢弃: {await response.text()}")
+                        return True
+                    else:
+                        print(f"服务器返回错误状态码: {response.status}")
+                        print(f"响应内容: {await response.text()}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"发送请求失败 (尝试 {attempt + 1}/{retry_attempts}): {e}")
+
+            if attempt < retry_attempts - 1:
+                await asyncio.sleep(2 ** attempt)  # 指数退避
+
+        print(f"无法发送报告到服务器: {report_data.get('id_short', 'unknown')}")
+        return False
+
+    async def send_reports(self, reports):
+        """批量发送报告数据到远程服务器，返回需要稍后重发的报告序号
+
+        服务器逐条校验后拒绝的报告重发也不会成功，记录日志后丢弃，不计入返回值。
+        """
+        url = self.config["server_url"] + self.config["batch_endpoint"]
+        retry_attempts = self.config["retry_attempts"]
+
+        for attempt in range(retry_attempts):
+            try:
+                async with self.session.post(url, json=reports) as response:
+                    if response.status == 200:
+                        results = (await response.json()).get('results', [])
+                        rejected = [item for item in results if not item['success']]
+                        for item in rejected:
+                            print(f"服务器拒绝报告 {reports[item['index']].get('id_short', 'unknown')}，已丢弃: {item.get('error')}")
+                        print(f"成功批量发送报告到服务器: {len(reports) - len(rejected)}/{len(reports)}")
+                        return []
+                    elif response.status == 404:
+                        # 服务器不支持批量接口（如 server.mjs），逐条发送
+                        print("服务器不支持批量接口，改为逐条发送")
+                        sent = await asyncio.gather(*(self.send_report(report) for report in reports))
+                        return [index for index, ok in enumerate(sent) if not ok]
+                    else:
+                        print(f"服务器返回错误状态码: {response.status}")
+                        print(f"响应内容: {await response.text()}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"批量发送请求失败 (尝试 {attempt + 1}/{retry_attempts}): {e}")
+
+            if attempt < retry_attempts - 1:
+                await asyncio.sleep(2 ** attempt)  # 指数退避
+
+        print(f"无法批量发送 {len(reports)} 条报告到服务器")
+        return list(range(len(reports)))
+
+    async def submit(self, reports):
+        """在后台发送一批报告；在途请求已满时等待空位"""
+        await self.window.acquire()
+
+        async def run():
+            try:
+                self.failed.extend(reports[index] for index in await self.send_reports(reports))
+            finally:
+                self.window.release()
+
+        task = asyncio.create_task(run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def drain(self):
+        """等待所有在途上传完成"""
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+
+class ReportOutbox:
+    """本地持久化发件箱：上传失败的报告追加写入 sqlite，下次运行时批量补发"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS outbox (
+                                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                report TEXT
+                            )''')
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def append(self, reports):
+        self.conn.executemany("INSERT INTO outbox (report) VALUES (?)",
+                              [(json.dumps(report),) for report in reports])
+        self.conn.commit()
+
+    def peek(self, after, limit):
+        """按写入顺序读取 seq 大于 after 的报告"""
+        rows = self.conn.execute(
+            "SELECT seq, report FROM outbox WHERE seq > ? ORDER BY seq LIMIT ?",
+            (after, limit)).fetchall()
+        return [(seq, json.loads(report)) for seq, report in rows]
+
+    def ack(self, seqs):
+        """删除服务器已确认写入的报告"""
+        self.conn.executemany("DELETE FROM outbox WHERE seq = ?", [(seq,) for seq in seqs])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+async def drain_outbox(outbox, uploader, batch_size):
+    """补发发件箱中的报告，删除服务器已写入或明确拒绝的条目"""
+    after = 0
+    sent = 0
+    while True:
+        entries = outbox.peek(after, batch_size)
+        if not entries:
+            break
+        after = entries[-1][0]
+        failed = set(await uploader.send_reports([report for _, report in entries]))
+        acked = [seq for index, (seq, _) in enumerate(entries) if index not in failed]
+        outbox.ack(acked)
+        sent += len(acked)
+    if sent:
+        print(f"发件箱补发完成: {sent} 条，剩余 {len(outbox)} 条")
+
+
+class FetchWatermarks:
+    """每个 hashed adv key 已抓取到的最新发布时间（秒），用于增量抓取"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS watermarks (
+                                id TEXT PRIMARY KEY,
+                                published INTEGER
+                            )''')
+        self.conn.commit()
+
+    def load(self):
+        return dict(self.conn.execute("SELECT id, published FROM watermarks").fetchall())
+
+    def update(self, latest):
+        """只向前推进水位"""
+        self.conn.executemany('''
+            INSERT INTO watermarks (id, published) VALUES (?, ?)
+            ON CONFLICT(id) DO UPDATE SET published = MAX(published, excluded.published)
+        ''', list(latest.items()))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class SeenReports:
+    """已处理报告的持久化去重集合，按 id+载荷 的哈希索引，超出上限时淘汰最久未见的条目"""
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS seen (
+                                digest BLOB PRIMARY KEY,
+                                seen_at INTEGER
+                            )''')
+        self.conn.commit()
+        self.digests = {row[0] for row in self.conn.execute("SELECT digest FROM seen")}
+        self.touched = set()
+        self.skipped = 0
+
+    @staticmethod
+    def digest(report):
+        return hashlib.sha256((report['id'] + report['payload']).encode()).digest()[:16]
+
+    def is_seen(self, digest):
+        if digest in self.digests:
+            self.touched.add(digest)
+            self.skipped += 1
+            return True
+        return False
+
+    def add(self, digest):
+        self.digests.add(digest)
+        self.touched.add(digest)
+
+    def save(self):
+        """写入本次见到的条目并淘汰超出上限的旧条目"""
+        now = int(time.time())
+        self.conn.executemany("INSERT OR REPLACE INTO seen (digest, seen_at) VALUES (?, ?)",
+                              [(digest, now) for digest in self.touched])
+        evicted = [row[0] for row in self.conn.execute('''
+            SELECT digest FROM seen ORDER BY seen_at
+            LIMIT MAX(0, (SELECT COUNT(*) FROM seen) - ?)
+        ''', (self.max_entries,))]
+        self.conn.executemany("DELETE FROM seen WHERE digest = ?", [(digest,) for digest in evicted])
+        self.conn.commit()
+        # 内存中的集合与表保持一致，常驻模式下不会无限增长
+        self.digests.difference_update(evicted)
+        self.touched.clear()
+
+    def close(self):
+        self.conn.close()
+
+
+class RotationSchedule:
+    """滚动密钥设备的轮换计划
+
+    固件按 .keys 文件中的顺序每隔 period 秒切换一次密钥。根据最近一条报告
+    记下 (密钥序号, 时间) 作为锚点，即可推算时间窗口内可能广播过的密钥，只查询这些密钥。
+    没有锚点或未配置周期的设备仍查询全部密钥。
+
+    固件重启或漂移超出 slack 后，正在广播的密钥会落在筛选范围之外，因此以下情况
+    退回查询全部密钥并重新校准锚点：上一轮筛选出的密钥都查询成功却没有取到任何报告，
+    或锚点已超过 resync_periods 个周期。查询全部密钥仍没有报告的设备只是暂时没有上报，
+    记为安静，恢复筛选且空结果不再退回全部密钥，直到再次取到报告。
+    """
+
+    def __init__(self, path, names, periods, default_period, slack, resync_periods=0):
+        self.periods = periods
+        self.default_period = default_period
+        self.slack = slack
+        self.resync_periods = resync_periods
+        # 未配置任何周期时不筛选，也就不必建立设备与密钥序号的映射
+        self.enabled = bool(default_period or periods)
+        self.device_of = {}
+        self.devices = {}
+        self.index = {}
+        if self.enabled:
+            # names.items() 按设备、密钥序号的顺序批量读出，列表下标即密钥序号
+            for id, name in names.items():
+                keys = self.devices.setdefault(name, [])
+                self.device_of[id] = name
+                self.index[id] = len(keys)
+                keys.append(id)
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS rotation_anchors (
+                                name TEXT PRIMARY KEY,
+                                key_index INTEGER,
+                                timestamp INTEGER,
+                                missed INTEGER NOT NULL DEFAULT 0,
+                                quiet INTEGER NOT NULL DEFAULT 0
+                            )''')
+        self.conn.commit()
+        self.anchors = {}
+        self.missed = set()
+        self.quiet = set()
+        for name, key_index, timestamp, missed, quiet in self.conn.execute(
+                "SELECT name, key_index, timestamp, missed, quiet FROM rotation_anchors"):
+            self.anchors[name] = (key_index, timestamp)
+            if missed:
+                self.missed.add(name)
+            if quiet:
+                self.quiet.add(name)
+        # 本轮 设备名 -> 选中的ID，分为按锚点筛选过的和查询全部密钥的
+        self.filtered = {}
+        self.unfiltered = {}
+        self.dirty = set()
+
+    def period(self, name):
+        return self.periods.get(name, self.default_period)
+
+    def allowed(self, name, start, end):
+        """返回设备在 [start, end] 内可能广播过的密钥序号，None 表示全部"""
+        keys = self.devices[name]
+        period = self.period(name)
+        anchor = self.anchors.get(name)
+        if len(keys) <= 1 or not period or anchor is None or name in self.missed:
+            return None
+        key_index, timestamp = anchor
+        if self.resync_periods > 0 and end - timestamp > self.resync_periods * period:
+            return None
+        first = math.floor((start - timestamp) / period) - self.slack
+        last = math.floor((end - timestamp) / period) + self.slack
+        if last - first + 1 >= len(keys):
+            return None
+        return {(key_index + slot) % len(keys) for slot in range(first, last + 1)}
+
+    def select(self, ids, start, end):
+        if not self.enabled:
+            return list(ids)
+        allowed = {}
+        selected = []
+        self.filtered = {}
+        self.unfiltered = {}
+        for id in ids:
+            name = self.device_of[id]
+            if name not in allowed:
+                allowed[name] = self.allowed(name, start, end)
+            if allowed[name] is None:
+                self.unfiltered.setdefault(name, []).append(id)
+            elif self.index[id] in allowed[name]:
+                self.filtered.setdefault(name, []).append(id)
             else:
-                print(f"服务器返回错误状态码: {response.status_code}")
-                print(f"响应内容: {response.text}")
-        except requests.exceptions.RequestException as e:
-            print(f"发送请求失败 (尝试 {attempt + 1}/{config['retry_attempts']}): {e}")
-        
-        if attempt < config["retry_attempts"] - 1:
-            time.sleep(2 ** attempt)  # 指数退避
-    
-    print(f"无法发送报告到服务器: {report_data.get('id_short', 'unknown')}")
-    return False
-
-
-def getAuth(regenerate=False, second_factor='sms'):
-    CONFIG_PATH = os.path.dirname(os.path.realpath(__file__)) + "/auth.json"
+                continue
+            selected.append(id)
+        return selected
+
+    def record(self, hits, fetched):
+        """一轮结束后根据取到报告的设备 hits 和查询成功的ID fetched 更新各设备的状态
+
+        只有选中的ID都查询成功时，空结果才能说明问题；查询失败、被跳过或本轮
+        没有选中任何ID的设备保持原状态。
+        """
+        for name, ids in self.filtered.items():
+            if name in hits:
+                if name in self.quiet:
+                    self.quiet.discard(name)
+                    self.dirty.add(name)
+                continue
+            if name in self.missed or name in self.quiet:
+                continue
+            if all(id in fetched for id in ids):
+                # 锚点推算的密钥上没有报告，可能已经漂移，下一轮查询全部密钥
+                self.missed.add(name)
+                self.dirty.add(name)
+        for name, ids in self.unfiltered.items():
+            if name in hits:
+                if name in self.missed or name in self.quiet:
+                    self.missed.discard(name)
+                    self.quiet.discard(name)
+                    self.dirty.add(name)
+            elif name in self.missed and all(id in fetched for id in ids):
+                # 全部密钥都没有报告，设备只是没有上报，锚点仍然可信
+                self.missed.discard(name)
+                self.quiet.add(name)
+                self.dirty.add(name)
+
+    def observe(self, id, timestamp):
+        """用解密出的报告更新设备的锚点，只保留最新的一条"""
+        if not self.enabled:
+            return
+        name = self.device_of[id]
+        anchor = self.anchors.get(name)
+        if anchor is None or timestamp > anchor[1]:
+            self.anchors[name] = (self.index[id], timestamp)
+            self.dirty.add(name)
+
+    def save(self):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO rotation_anchors (name, key_index, timestamp, missed, quiet) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(name,) + self.anchors[name] + (int(name in self.missed), int(name in self.quiet))
+             for name in self.dirty if name in self.anchors])
+        self.conn.commit()
+        self.dirty.clear()
+
+    def close(self):
+        self.conn.close()
+
+
+def plan_batches(ids, startdate, watermarks, overlap, batch_size):
+    """按各ID的起始时间排序后分批，每批使用批内最早的起始时间"""
+    starts = {id: max(startdate, watermarks[id] - overlap) if id in watermarks else startdate
+              for id in ids}
+    ordered_ids = sorted(starts, key=starts.get)
+    return [(starts[batch[0]], batch) for batch in chunked(ordered_ids, batch_size)]
+
+
+def getAuth(regenerate=False, second_factor='sms', auth_file='auth.json'):
+    CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), auth_file)
     if os.path.exists(CONFIG_PATH) and not regenerate:
         with open(CONFIG_PATH, "r") as f:
             j = json.load(f)
     else:
+        from pypush_gsa_icloud import icloud_login_mobileme
         mobileme = icloud_login_mobileme(second_factor=second_factor)
         j = {'dsid': mobileme['dsid'], 'searchPartyToken': mobileme['delegates']
              ['com.apple.mobileme']['service-data']['tokens']['searchPartyToken']}
@@ -95,129 +495,741 @@ def getAuth(regenerate=False, second_factor='sms'):
     return (j['dsid'], j['searchPartyToken'])
 
 
-async def fetch_report(session, semaphore, id, auth, headers, startdate, unixEpoch):
-    """异步获取单个ID的报告"""
+class Account:
+    """一个 Apple ID 凭据，拥有独立的会话和并发预算"""
+
+    def __init__(self, auth_file, config):
+        self.name = auth_file
+        self.auth_file = auth_file
+        self.auth = None
+        self.mtime = None
+        self.session = None
+        # 自适应并发（上限 fetch_concurrency）
+        self.controller = FetchController(
+            initial=config["fetch_initial_concurrency"],
+            maximum=config["fetch_concurrency"],
+            target_latency=config["fetch_target_latency"],
+            retry_attempts=config["fetch_retry_attempts"]
+        )
+
+    def load(self, regenerate=False, second_factor='sms'):
+        dsid, searchPartyToken = getAuth(regenerate, second_factor, self.auth_file)
+        self.auth = aiohttp.BasicAuth(dsid, searchPartyToken)
+        self.mtime = os.path.getmtime(os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), self.auth_file))
+
+    def reload_if_changed(self):
+        """凭据文件被更新（如另一进程重新登录）后重新加载并解除熔断"""
+        path = os.path.join(os.path.dirname(os.path.realpath(__file__)), self.auth_file)
+        if not os.path.exists(path) or os.path.getmtime(path) == self.mtime:
+            return False
+        self.load()
+        self.controller.reset()
+        print(f"账号 {self.name} 凭据已更新，恢复使用")
+        return True
+
+    @property
+    def healthy(self):
+        return not self.controller.tripped
+
+
+def shard(id, accounts):
+    """按 hashed adv key 把ID稳定地分配给一个账号"""
+    return accounts[int.from_bytes(base64.b64decode(id)[:4], 'big') % len(accounts)]
+
+
+class LeaseClient:
+    """通过服务器的 fetch_leases 表租用密钥分片，多台主机互不重复抓取
+
+    分片只在持有者续租时由它自己让出，不会被其他 worker 直接接管，因此 owns()
+    为真的分片不会同时被另一个 worker 抓取。发件箱、水位、去重和轮换锚点等本地状态
+    保存在脚本目录下，同一台主机（同一份代码目录）只支持运行一个抓取进程。
+    """
+
+    def __init__(self, config, session):
+        self.config = config
+        self.session = session
+        self.worker = f"{socket.gethostname()}-{os.getpid()}"
+        self.shards = set()
+        self.quota = 0
+        self.renewed = 0.0
+
+    def owns(self, id):
+        # 租约在本地已过期时分片可能已交给其他 worker
+        if time.monotonic() - self.renewed > self.config["lease_ttl"]:
+            return False
+        # 与账号分片使用不同的字节，避免某个 worker 只用到部分账号
+        return int.from_bytes(base64.b64decode(id)[4:8], 'big') % self.config["lease_shards"] in self.shards
+
+    async def acquire(self):
+        """租用或续租分片，返回当前持有的分片"""
+        url = self.config["server_url"] + self.config["lease_endpoint"] + "/acquire"
+        data = {"worker": self.worker, "shard_count": self.config["lease_shards"],
+                "ttl": self.config["lease_ttl"]}
+        async with self.session.post(url, json=data) as response:
+            if response.status != 200:
+                raise RuntimeError(f"租用分片失败: {response.status} {await response.text()}")
+            result = await response.json()
+        shards = set(result["shards"])
+        if shards != self.shards:
+            print(f"worker {self.worker} 持有 {len(shards)}/{self.config['lease_shards']} 个分片"
+                  f"（在线 worker: {result['workers']}）")
+        self.shards = shards
+        self.quota = math.ceil(self.config["lease_shards"] / max(result["workers"], 1))
+        self.renewed = time.monotonic()
+        return self.shards
+
+    async def settle(self, timeout):
+        """等待分片均分：超出配额的 worker 续租时才让出分片，期间每秒续租一次，最多等待 timeout 秒"""
+        deadline = time.monotonic() + timeout
+        while True:
+            await asyncio.sleep(1)
+            await self.acquire()
+            if len(self.shards) >= self.quota or time.monotonic() >= deadline:
+                return self.shards
+
+    async def keepalive(self):
+        """定期续租；超过租期仍无法续租时放弃全部分片，交给其他 worker"""
+        while True:
+            await asyncio.sleep(self.config["lease_ttl"] / 3)
+            try:
+                await self.acquire()
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+                print(f"续租失败: {e}")
+                if time.monotonic() - self.renewed > self.config["lease_ttl"]:
+                    self.shards = set()
+
+    async def release(self):
+        url = self.config["server_url"] + self.config["lease_endpoint"] + "/release"
+        try:
+            async with self.session.post(url, json={"worker": self.worker}) as response:
+                await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"释放分片失败: {e}")
+        self.shards = set()
+
+
+def chunked(items, size):
+    """按固定大小切分列表"""
+    items = list(items)
+    size = max(1, size)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def map_results_to_ids(results, ids):
+    """将接口返回的报告按ID归类，丢弃不属于本批次的结果"""
+    mapped = {id: [] for id in ids}
+    for report in results:
+        if report.get('id') in mapped:
+            mapped[report['id']].append(report)
+    return mapped
+
+
+# 只有这些状态码可能由批内某个ID引起，二分拆批重试；其他 4xx 拆批也不会成功
+SPLIT_STATUSES = (400, 413)
+
+
+class AuthError(Exception):
+    """searchPartyToken 已失效（401），需要重新登录"""
+
+
+def parse_retry_after(value, default):
+    """解析 Retry-After 头（秒数或 HTTP 日期），返回需要等待的秒数"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class FetchController:
+    """fetch_report 的流量控制：AIMD 自适应并发、Retry-After 暂停、抖动退避和 401 熔断"""
+
+    def __init__(self, initial=16, maximum=100, target_latency=5.0, retry_attempts=3, retry_base=1.0):
+        self.limit = float(min(initial, maximum))
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.retry_attempts = retry_attempts
+        self.retry_base = retry_base
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.tripped = None  # 熔断原因
+        self.stopped = None  # 本轮停止原因（如 403），下一轮自动恢复
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self
+
+    async def __aexit__(self, *exc):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, latency):
+        """加性增：延迟正常时每轮窗口增加约一个并发"""
+        if latency > self.target_latency:
+            self.on_error()
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_error(self):
+        """乘性减：一个目标延迟周期内最多减半一次，避免一波失败把并发压到底"""
+        now = time.monotonic()
+        if now - self.last_decrease >= self.target_latency:
+            self.limit = max(1.0, self.limit / 2)
+            self.last_decrease = now
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def backoff(self, attempt):
+        return self.retry_base * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def trip(self, reason):
+        if self.tripped is None:
+            print(f"熔断: {reason}，停止本轮剩余请求")
+        self.tripped = reason
+
+    def stop(self, reason):
+        if self.tripped is None and self.stopped is None:
+            print(f"停止本轮剩余请求: {reason}")
+        self.stopped = reason
+
+    def resume(self):
+        """新一轮开始时解除上一轮的停止，熔断仍需凭据更新后才解除"""
+        self.stopped = None
+
+    def reset(self):
+        self.tripped = None
+        self.stopped = None
+
+
+async def fetch_report(session, controller, ids, auth, headers, startdate, unixEpoch):
+    """异步获取一批ID的报告，返回 {id: [报告]}，只包含请求成功的ID
+
+    限流或服务端错误时按 Retry-After 和抖动退避重试，400/413 二分拆批重试，
+    401 时熔断，403（如 anisette 头被拒）时停止本轮，剩余请求直接放弃。
+    请求失败或未发出的ID不出现在结果中，调用方据此区分“没有报告”和“没有查到”。
+    """
+    ids = list(ids)
     data = {
         "search": [{
             "startDate": startdate * 1000,
             "endDate": unixEpoch * 1000,
-            "ids": [id]  # 每次只请求一个ID
+            "ids": ids
         }]
     }
 
-    async with semaphore:  # 信号量控制并发数
-        try:
-            async with session.post(
-                "https://gateway.icloud.com/acsnservice/fetch",
-                auth=auth,
-                headers=headers,
-                json=data
-            ) as response:
-                if response.status == 200:
-                    res_data = await response.json()
-                    results = res_data['results']
-                    print("Request ID:", data["search"][0]["ids"])
-                    print(f'{response.status}: {len(results)} reports received.')
-                    return res_data.get('results', [])
+    status = None
+    for attempt in range(controller.retry_attempts):
+        status = None
+        async with controller:  # 自适应并发控制
+            if controller.tripped or controller.stopped:
+                return {}
+            started = time.monotonic()
+            try:
+                async with session.post(
+                    "https://gateway.icloud.com/acsnservice/fetch",
+                    auth=auth,
+                    headers=headers,
+                    json=data
+                ) as response:
+                    status = response.status
+                    if status == 200:
+                        res_data = await response.json()
+                        controller.on_success(time.monotonic() - started)
+                        results = res_data.get('results', [])
+                        print(f"Request IDs: {len(ids)} (first: {ids[0]})")
+                        print(f'{response.status}: {len(results)} reports received.')
+                        return map_results_to_ids(results, ids)
+                    print(f"Error {status} for {len(ids)} IDs (first: {ids[0]})")
+                    if status == 401:
+                        controller.trip("401 Unauthorized")
+                        return {}
+                    if status == 403:
+                        controller.stop("403 Forbidden")
+                        return {}
+                    if status in (429, 503):
+                        controller.pause(parse_retry_after(
+                            response.headers.get('Retry-After'), controller.backoff(attempt)))
+            except Exception as e:
+                print(f"Exception for {len(ids)} IDs (first: {ids[0]}): {str(e)}")
+            controller.on_error()
+
+        # 限流、服务端错误和网络异常重试同一批，其他错误不再重试
+        transient = status is None or status == 429 or status >= 500
+        if not transient:
+            break
+        if attempt < controller.retry_attempts - 1:
+            await asyncio.sleep(controller.backoff(attempt))
+
+    # 拆分因内容被拒绝的批次并重试，单个ID失败则放弃
+    if status in SPLIT_STATUSES and len(ids) > 1:
+        half = len(ids) // 2
+        parts = await asyncio.gather(
+            fetch_report(session, controller, ids[:half], auth,
+                         headers, startdate, unixEpoch),
+            fetch_report(session, controller, ids[half:], auth,
+                         headers, startdate, unixEpoch)
+        )
+        return {id: reports for part in parts for id, reports in part.items()}
+    return {}
+
+
+class StageStats:
+    """流水线单个阶段的吞吐统计"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy = 0.0
+        self.started = time.perf_counter()
+
+    def add(self, count, elapsed):
+        self.count += count
+        self.busy += elapsed
+
+    def summary(self):
+        wall = max(time.perf_counter() - self.started, 1e-9)
+        return (f'{self.name}: {self.count} items, {self.count / wall:.1f}/s, '
+                f'busy {self.busy:.2f}s / wall {wall:.2f}s')
+
+
+# 队列结束标记
+QUEUE_DONE = None
+
+
+async def fetch_stage(accounts, batches, anisette, unixEpoch, out_queue, fetched, stats, owns=None):
+    """抓取阶段：每个批次完成后立即把报告送入解密队列
+
+    fetched 记录查询成功的ID及取到的报告数，没有出现的ID本轮没有查到。
+    batches 为 (账号, 起始时间, ID列表)；账号失效时，因熔断没有查到的ID转给其他账号，
+    已经成功查询过（包括确实没有报告）的ID不会重复抓取。
+    owns 不为空时，批次开始前跳过已不属于本 worker 的ID（分片已被其他 worker 接管）。
+    """
+    async def run(account, batch_start, batch):
+        if owns is not None:
+            batch = [id for id in batch if owns(id)]
+            if not batch:
+                return
+        started = time.perf_counter()
+        headers = await anisette.get_async()
+        mapped = await fetch_report(account.session, account.controller, batch,
+                                    account.auth, headers, batch_start, unixEpoch)
+        fetched.update((id, len(items)) for id, items in mapped.items())
+        reports = [report for items in mapped.values() for report in items]
+        stats.add(len(reports), time.perf_counter() - started)
+        if reports:
+            await out_queue.put(reports)
+
+        if not account.healthy:
+            healthy = [other for other in accounts if other.healthy]
+            retry = [id for id in batch if id not in mapped]
+            if healthy and retry:
+                groups = {}
+                for id in retry:
+                    groups.setdefault(shard(id, healthy), []).append(id)
+                await asyncio.gather(*(run(other, batch_start, ids)
+                                       for other, ids in groups.items()))
+
+    try:
+        await asyncio.gather(*(run(account, batch_start, batch)
+                               for account, batch_start, batch in batches))
+    finally:
+        await out_queue.put(QUEUE_DONE)
+
+
+async def decrypt_stage(in_queue, out_queue, engine, seen, rotation, privkeys, names, startdate, ordered, found,
+                        latest, undecrypted, stats):
+    """解密阶段：跳过已处理过的报告，其余分批并行交给解密引擎，结果送入上传队列
+
+    latest 记录各ID已处理完（解密成功、之前已处理过或早于时间窗口）的最新发布时间，
+    undecrypted 记录各ID解密失败的最早发布时间，用于推进抓取水位。
+    """
+    def note(marks, report, pick):
+        published = report['datePublished'] // 1000
+        marks[report['id']] = pick(marks.get(report['id'], published), published)
+
+    async def worker():
+        while True:
+            reports = await in_queue.get()
+            if reports is QUEUE_DONE:
+                await in_queue.put(QUEUE_DONE)  # 通知其他解密协程结束
+                break
+            started = time.perf_counter()
+            reports = [report for report in reports if report['id'] in privkeys]
+            digests = [SeenReports.digest(report) for report in reports]
+            fresh = []
+            for report, digest in zip(reports, digests):
+                if seen.is_seen(digest):
+                    note(latest, report, max)
                 else:
-                    print(f"Error {response.status} for ID {id}")
-                    return []
-        except Exception as e:
-            print(f"Exception for ID {id}: {str(e)}")
-            return []
+                    fresh.append((report, digest))
+            reports = [report for report, _ in fresh]
+            tags = await engine.decrypt_many_async(
+                [(privkeys[report['id']], report['payload'], report['id'])
+                 for report in reports],
+                startdate
+            )
+            uploads = []
+            for (report, digest), tag in zip(fresh, tags):
+                if tag is None:
+                    # 早于时间窗口或载荷损坏的报告重新抓取也没有用，不阻挡水位
+                    try:
+                        retry = payload_timestamp(report['payload']) >= startdate
+                    except ValueError:
+                        retry = False
+                    note(undecrypted if retry else latest, report, min if retry else max)
+                    continue
+                note(latest, report, max)
+                seen.add(digest)
+                rotation.observe(report['id'], tag['timestamp'])
+                uploads.append(build_report_data(report, tag, names[report['id']]))
+                found.add(tag['key'])
+                ordered.append(tag)
+            stats.add(len(uploads), time.perf_counter() - started)
+            if uploads:
+                await out_queue.put(uploads)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(engine.workers)))
+    finally:
+        await out_queue.put(QUEUE_DONE)
+
+
+async def upload_stage(in_queue, uploader, config, stats):
+    """上传阶段：攒够一批后交给异步上传器，与抓取和解密并行进行"""
+    pending = []
+
+    async def flush():
+        batch = pending[:config["upload_batch_size"]]
+        del pending[:len(batch)]
+        started = time.perf_counter()
+        await uploader.submit(batch)
+        stats.add(len(batch), time.perf_counter() - started)
+
+    while True:
+        uploads = await in_queue.get()
+        if uploads is QUEUE_DONE:
+            break
+        pending.extend(uploads)
+        while len(pending) >= config["upload_batch_size"]:
+            await flush()
+    while pending:
+        await flush()
+    await uploader.drain()
 
 
-async def main_async(args, privkeys, names):
+class ReportFetcher:
+    """抓取会话：在内存中持有认证、解密引擎、上传器和本地状态，可连续执行多轮抓取"""
+
+    def __init__(self, args, config, privkeys, names, accounts):
+        self.args = args
+        self.config = config
+        self.privkeys = privkeys
+        self.names = names
+        self.accounts = accounts
+
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        self.watermarks = FetchWatermarks(os.path.join(script_dir, config["watermark_path"]))
+        self.marks = {} if args.full else self.watermarks.load()
+        self.outbox = ReportOutbox(os.path.join(script_dir, config["outbox_path"]))
+        self.seen = SeenReports(os.path.join(script_dir, config["seen_path"]),
+                                config["seen_max_entries"])
+        self.rotation = RotationSchedule(os.path.join(script_dir, config["rotation_path"]),
+                                         names, config["rotation_periods"],
+                                         config["rotation_period"], config["rotation_slack"],
+                                         config["rotation_resync_periods"])
+        # 解密在进程池中进行，避免占满事件循环线程
+        self.engine = DecryptionEngine(workers=args.workers,
+                                       key_cache_size=config["key_cache_size"])
+        # anisette 头在有效期内复用，并在过期前于后台刷新
+        self.anisette = AnisetteProvider(config["anisette_urls"] or None,
+                                         ttl=config["anisette_ttl"])
+        self.uploader = None
+        self.prefetch_task = None
+
+    async def __aenter__(self):
+        for account in self.accounts:
+            account.session = aiohttp.ClientSession()
+        self.uploader = await ReportUploader(self.config).__aenter__()
+        await self.anisette.get_async()
+        self.prefetch_task = asyncio.create_task(self.anisette.prefetch())
+        return self
+
+    async def __aexit__(self, *exc):
+        self.prefetch_task.cancel()
+        await self.uploader.__aexit__(*exc)
+        for account in self.accounts:
+            await account.session.close()
+        self.engine.close()
+        self.outbox.close()
+        self.watermarks.close()
+        self.seen.close()
+        self.rotation.close()
+
+    async def sweep(self, ids, owns=None):
+        """对给定ID执行一轮 抓取 -> 解密 -> 上传，返回 (报告列表, 找到的设备, 有新数据的ID)
+
+        owns 用于 worker 模式，抓取每一批前重新确认ID仍归本 worker 所有。
+        """
+        config = self.config
+
+        # 计算时间范围
+        unixEpoch = int(datetime.datetime.now().timestamp())
+        startdate = unixEpoch - (60 * 60 * self.args.hours)
+        ordered = []
+        found = set()
+
+        # 滚动密钥设备只查询窗口内可能广播过的密钥
+        selected = self.rotation.select(ids, startdate, unixEpoch)
+        if len(selected) < len(ids):
+            print(f"轮换密钥筛选: {len(selected)}/{len(ids)} 个ID")
+        ids = selected
+
+        # 抓取 -> 解密 -> 上传 流式处理，有界队列提供背压
+        decrypt_queue = asyncio.Queue(maxsize=config["queue_size"])
+        upload_queue = asyncio.Queue(maxsize=config["queue_size"])
+        fetch_stats = StageStats('fetch')
+        decrypt_stats = StageStats('decrypt')
+        upload_stats = StageStats('upload')
+
+        # 按 hashed adv key 把ID分给可用账号，每个账号独立分批
+        for account in self.accounts:
+            account.controller.resume()
+        healthy = [account for account in self.accounts if account.healthy]
+        if not healthy:
+            raise AuthError("所有账号均已失效")
+        shards = {}
+        for id in ids:
+            shards.setdefault(shard(id, healthy), []).append(id)
+
+        # 增量抓取：每个ID从上次抓到的位置（减去重叠时间）开始
+        batches = [(account, batch_start, batch)
+                   for account, shard_ids in shards.items()
+                   for batch_start, batch in plan_batches(
+                       shard_ids, startdate, self.marks,
+                       config["watermark_overlap"], self.args.batch_size)]
+        latest = {}
+        undecrypted = {}
+        fetched = {}
+        print(f"增量抓取: {sum(1 for id in ids if id in self.marks)}/{len(ids)} 个ID")
+
+        # 上次未能上传的报告在后台补发
+        if len(self.outbox):
+            print(f"发件箱中有 {len(self.outbox)} 条待补发报告")
+        skipped = self.seen.skipped
+
+        await asyncio.gather(
+            drain_outbox(self.outbox, self.uploader, config["upload_batch_size"]),
+            fetch_stage(self.accounts, batches, self.anisette,
+                        unixEpoch, decrypt_queue, fetched, fetch_stats, owns),
+            decrypt_stage(decrypt_queue, upload_queue, self.engine, self.seen, self.rotation,
+                          self.privkeys, self.names, startdate, ordered, found,
+                          latest, undecrypted, decrypt_stats),
+            upload_stage(upload_queue, self.uploader, config, upload_stats)
+        )
+
+        # 本轮上传失败的报告写入发件箱，等待下次补发
+        if self.uploader.failed:
+            self.outbox.append(self.uploader.failed)
+            print(f"{len(self.uploader.failed)} 条报告上传失败，已写入发件箱")
+            self.uploader.failed = []
+
+        # 报告已解密并上传或写入发件箱，推进抓取水位；有报告解密失败的ID
+        # 只推进到失败的报告之前，下次抓取时重新取回
+        for id, published in undecrypted.items():
+            if id in latest:
+                latest[id] = min(latest[id], published - 1)
+        fresh = {id for id, published in latest.items()
+                 if published > self.marks.get(id, 0)}
+        self.watermarks.update(latest)
+        for id in fresh:
+            self.marks[id] = latest[id]
+        self.seen.save()
+        # 取到过报告（包括已处理过的重复报告）的设备都算命中
+        self.rotation.record({self.names[id] for id, count in fetched.items() if count}, fetched)
+        self.rotation.save()
+        print(f"跳过重复报告: {self.seen.skipped - skipped} 条")
+
+        print(f'Total: {fetch_stats.count} reports received.')
+        for stats in (fetch_stats, decrypt_stats, upload_stats):
+            print(stats.summary())
+        for account in self.accounts:
+            print(f'{account.name}: {len(shards.get(account, []))} IDs, '
+                  f'fetch concurrency {account.controller.limit:.1f}'
+                  + ('' if account.healthy else f', 已熔断 ({account.controller.tripped})')
+                  + (f', 本轮已停止 ({account.controller.stopped})' if account.controller.stopped else ''))
+
+        # 熔断时已抓到的数据照常保存；所有账号都失效时通知调用方
+        if not any(account.healthy for account in self.accounts):
+            raise AuthError("所有账号均已失效")
+        return ordered, found, fresh
+
+
+class PollScheduler:
+    """按设备自适应轮询：有新数据的设备缩短间隔，安静或离线的设备逐步退避
+
+    滚动密钥设备的每个密钥只在轮换周期的一小段内广播，按密钥退避会让刚开始广播的
+    密钥被推迟到最长间隔才查询，因此间隔按设备记录，同一设备的所有密钥一起调度。
+    """
+
+    def __init__(self, names, min_interval, max_interval, backoff=2.0, now=None):
+        now = time.time() if now is None else now
+        self.names = names
+        self.devices = {}
+        for id, name in names.items():
+            self.devices.setdefault(name, []).append(id)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.intervals = {name: min_interval for name in self.devices}
+        # 首轮在一个最短间隔内均匀错开，避免所有设备同时请求
+        self.next_due = {name: now + min_interval * i / max(len(self.devices), 1)
+                         for i, name in enumerate(self.devices)}
+
+    def due(self, now, limit=0, owns=None):
+        """返回已到期设备的ID，最早到期的设备优先
+
+        limit 限制ID总数，按整台设备截断（至少返回一台）；owns 不为空时只返回其中的ID。
+        """
+        ids = []
+        for name in sorted((name for name, due in self.next_due.items() if due <= now),
+                           key=self.next_due.get):
+            keys = self.devices[name] if owns is None else [id for id in self.devices[name] if owns(id)]
+            if limit > 0 and ids and len(ids) + len(keys) > limit:
+                break
+            ids.extend(keys)
+        return ids
+
+    def record(self, ids, fresh, now):
+        """根据本轮是否有新数据调整所抓取设备的轮询间隔，设备的任一密钥有新数据即算有新数据"""
+        fresh = {self.names[id] for id in fresh}
+        for name in {self.names[id] for id in ids}:
+            if name in fresh:
+                interval = max(self.min_interval, self.intervals[name] / self.backoff)
+            else:
+                interval = min(self.max_interval, self.intervals[name] * self.backoff)
+            self.intervals[name] = interval
+            # 加入随机抖动，防止间隔相同的设备重新聚集到同一时刻
+            self.next_due[name] = now + interval * random.uniform(0.9, 1.1)
+
+    def next_wakeup(self):
+        return min(self.next_due.values())
+
+
+async def run_daemon(fetcher, config, leases=None):
+    """常驻模式：复用会话、密钥和认证信息，按调度器逐批抓取到期的ID
+
+    worker 模式下只抓取当前租到的分片内的ID。
+    """
+    scheduler = PollScheduler(fetcher.names, config["poll_min_interval"],
+                              config["poll_max_interval"], config["poll_backoff"])
+    print(f"常驻模式启动: {len(scheduler.devices)} 个设备，{len(fetcher.names)} 个ID")
+    while True:
+        for account in fetcher.accounts:
+            if not account.healthy:
+                account.reload_if_changed()
+        due = scheduler.due(time.time(), config["poll_max_keys"],
+                            leases.owns if leases is not None else None)
+        if due:
+            try:
+                _, _, fresh = await fetcher.sweep(due, leases.owns if leases is not None else None)
+            except AuthError as e:
+                # 常驻模式无法交互登录，等待凭据文件被更新后恢复
+                print(f"认证失效: {e}，请重新登录对应账号")
+                fresh = set()
+            except Exception as e:
+                print(f"本轮抓取失败: {e}")
+                fresh = set()
+            scheduler.record(due, fresh, time.time())
+            print(f"本轮抓取 {len(due)} 个ID，{len(fresh)} 个有新数据")
+        await asyncio.sleep(max(scheduler.next_wakeup() - time.time(), config["poll_tick"]))
+
+
+class StartupProfile:
+    """启动各阶段耗时统计，--profile-startup 时在开始抓取前打印"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.steps = [('导入模块', IMPORT_END - IMPORT_START)]
+        self.last = IMPORT_END
+
+    def mark(self, step):
+        now = time.perf_counter()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def report(self):
+        if not self.enabled:
+            return
+        print('启动耗时:')
+        for step, elapsed in self.steps:
+            print(f'  {step}: {elapsed * 1000:.1f} ms')
+        print(f'  合计: {(self.last - IMPORT_START) * 1000:.1f} ms')
+        print(f'  登录模块已导入: {"pypush_gsa_icloud" in sys.modules}')
+
+
+async def main_async(args, privkeys, names, profile=None):
     """异步主函数"""
+    profile = profile or StartupProfile()
     # 加载配置
     config = load_config()
     print(f"使用服务器配置: {config['server_url']}{config['api_endpoint']}")
+    profile.mark('加载配置')
 
-    # 获取认证信息
-    dsid, searchPartyToken = getAuth(
-        regenerate=args.regen,
-        second_factor='trusted_device' if args.trusteddevice else 'sms'
-    )
-    auth = aiohttp.BasicAuth(dsid, searchPartyToken)
-    headers = generate_anisette_headers()
-
-    # 计算时间范围
-    unixEpoch = int(datetime.datetime.now().timestamp())
-    startdate = unixEpoch - (60 * 60 * args.hours)
-
-    # 设置信号量（并发数=100）
-    semaphore = asyncio.Semaphore(100)
-    ordered = []
-    found = set()
-
-    async with aiohttp.ClientSession() as session:
-        tasks = [
-            fetch_report(session, semaphore, id, auth,
-                         headers, startdate, unixEpoch)
-            for id in names.keys()
-        ]
-        results = await asyncio.gather(*tasks)
-
-    # 合并所有报告
-    all_reports = [report for sublist in results for report in sublist]
-    print(f'Total: {len(all_reports)} reports received.')
-    """ for report in all_reports: print(report) """
-
-    # 处理报告
-    for report in all_reports:
-        if report['id'] not in privkeys:
-            continue
-
-        priv = int.from_bytes(base64.b64decode(privkeys[report['id']]), 'big')
-        data = base64.b64decode(report['payload'])
-        if len(data) > 88:
-            data = data[:4] + data[5:]
-
-        # 解密处理（保持原逻辑）
-        timestamp = int.from_bytes(data[0:4], 'big') + 978307200
-        """ sq3.execute(f"INSERT OR REPLACE INTO reports VALUES ('{names[report['id']]}', {timestamp}, {report['datePublished']}, '{report['payload']}', '{report['id']}', {report['statusCode']})") """
-
-        """ print("t,s:",timestamp,startdate) """
-
-        if timestamp >= startdate:
-            eph_key = ec.EllipticCurvePublicKey.from_encoded_point(
-                ec.SECP224R1(), data[5:62])
-            shared_key = ec.derive_private_key(
-                priv, ec.SECP224R1(), default_backend()).exchange(ec.ECDH(), eph_key)
-            symmetric_key = sha256(
-                shared_key + b'\x00\x00\x00\x01' + data[5:62])
-            decryption_key = symmetric_key[:16]
-            iv = symmetric_key[16:]
-            enc_data = data[62:72]
-            tag = data[72:]
-
-            decrypted = decrypt(enc_data, algorithms.AES(
-                decryption_key), modes.GCM(iv, tag))
-            tag = decode_tag(decrypted)
-            tag['timestamp'] = timestamp
-            tag['isodatetime'] = datetime.datetime.fromtimestamp(
-                timestamp).isoformat()
-            tag['key'] = names[report['id']]
-            tag['goog'] = 'https://maps.google.com/maps?q=' + \
-                str(tag['lat']) + ',' + str(tag['lon'])
-            found.add(tag['key'])
-            ordered.append(tag)
-
-            # 发送数据到远程服务器
-            report_data = {
-                'id_short': names[report['id']],
-                'timestamp': timestamp,
-                'isodatetime': tag['isodatetime'],
-                'datePublished': report['datePublished'],
-                'latitude': tag['lat'],
-                'longitude': tag['lon'],
-                'payload': report['payload'],
-                'id': report['id'],
-                'status': tag['status'],
-                'statusCode': report['statusCode']
-            }
-            
-            send_report_to_server(report_data, config)
+    # 获取认证信息，每个凭据文件对应一个账号；-r 只重新登录 --account 指定的账号
+    accounts = [Account(auth_file, config) for auth_file in config["auth_profiles"]]
+    if args.account and args.account not in [account.name for account in accounts]:
+        raise SystemExit(f"--account {args.account} 不在 config.json 的 auth_profiles 中: "
+                         f"{config['auth_profiles']}")
+    regen_account = args.account or accounts[0].name
+    for account in accounts:
+        account.load(
+            regenerate=args.regen and account.name == regen_account,
+            second_factor='trusted_device' if args.trusteddevice else 'sms'
+        )
+    profile.mark('加载凭据')
+
+    async with ReportFetcher(args, config, privkeys, names, accounts) as fetcher:
+        profile.mark('初始化抓取器')
+        profile.report()
+        # worker 模式：从服务器租用密钥分片，只抓取自己持有的部分
+        leases = None
+        if args.worker:
+            leases = LeaseClient(config, fetcher.uploader.session)
+            await leases.acquire()
+            keepalive = asyncio.create_task(leases.keepalive())
+        try:
+            if args.daemon:
+                await run_daemon(fetcher, config, leases)
+                return
+            if leases is not None and config["lease_settle"] > 0:
+                # 同时启动的 worker 先各自注册，再等其他 worker 续租让出多余的分片
+                await leases.settle(config["lease_settle"])
+            ids = [id for id in names if leases is None or leases.owns(id)]
+            try:
+                ordered, found, _ = await fetcher.sweep(ids, leases.owns if leases is not None else None)
+            except AuthError as e:
+                print(f"认证失效: {e}，请使用 -r [-a 凭据文件] 重新获取 searchPartyToken")
+                return
+        finally:
+            if leases is not None:
+                keepalive.cancel()
+                await leases.release()
 
     # 输出结果
     print(f'{len(ordered)} reports processed.')
@@ -225,7 +1237,8 @@ async def main_async(args, privkeys, names):
     for rep in ordered:
         print(rep)
     print(f'Found:   {list(found)}')
-    print(f'Missing: {[key for key in names.values() if key not in found]}')
+    queried = set(ids)
+    print(f'Missing: {[name for id, name in names.items() if id in queried and name not in found]}')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -237,45 +1250,30 @@ if __name__ == "__main__":
         '-r', '--regen', help='regenerate search-party-token', action='store_true')
     parser.add_argument('-t', '--trusteddevice',
                         help='use trusted device for 2FA instead of SMS', action='store_true')
+    parser.add_argument(
+        '-b', '--batch-size', help='number of hashed keys sent in each fetch request', type=int, default=1)
+    parser.add_argument(
+        '-w', '--workers', help='decryption worker processes (default: number of CPU cores)', type=int, default=None)
+    parser.add_argument(
+        '-f', '--full', help='ignore fetch watermarks and fetch the whole --hours window', action='store_true')
+    parser.add_argument(
+        '-a', '--account', help='auth profile (from auth_profiles in config.json) that --regen logs in again', default=None)
+    parser.add_argument(
+        '--worker', help='lease key shards from the server so fetchers on several hosts can run side by side '
+             '(local state files are shared, so run one fetcher per host)', action='store_true')
+    parser.add_argument(
+        '-d', '--daemon', help='keep running and poll keys on an adaptive schedule', action='store_true')
+    parser.add_argument(
+        '--profile-startup', help='print import and initialization timings before fetching', action='store_true')
     args = parser.parse_args()
+    profile = StartupProfile(args.profile_startup)
+    profile.mark('解析参数')
 
-    # Read key files and store keys in dictionaries
-    privkeys = {}
-    names = {}
-    # 递归 glob.glob 调用取出目录下所有keys
-    keyfiles_pattern = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'keys', '**', args.prefix + '*.keys')
-    keyfiles = glob.glob(keyfiles_pattern, recursive=True)
-    for keyfile in keyfiles:
-        with open(keyfile) as f:
-            name = os.path.basename(keyfile)[len(args.prefix):-5]
-            current_priv = None
-            current_hashed_adv = None
-            current_adv = None
-            isempty = True
-
-            for line in f:
-                key = line.rstrip('\n').split(': ')
-                if key[0] == 'Private key':
-                    current_priv = key[1]
-                elif key[0] == 'Advertisement key':
-                    current_adv = key[1]
-                elif key[0] == 'Hashed adv key':
-                    current_hashed_adv = key[1]
-
-                # When we have a complete key set, store it
-                if current_priv and current_adv and current_hashed_adv:
-                    # Add to dictionaries
-                    privkeys[current_hashed_adv] = current_priv
-                    names[current_hashed_adv] = name
-
-                    # Reset for next key pair
-                    current_priv = current_adv = current_hashed_adv = None
-                    if isempty:
-                        isempty = False
-
-            # If we didn't find any key pairs in this file
-            if isempty is True:
-                print(f"Couldn't find valid key pair in {keyfile}")
+    # 读取编译后的密钥索引，只有修改过的 .keys 文件才会重新解析
+    key_index = KeyIndex(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'keys'), args.prefix)
+    privkeys = key_index.privkeys
+    names = key_index.names
+    profile.mark('读取密钥索引')
 
     # 运行异步主函数
-    asyncio.run(main_async(args, privkeys, names))
+    asyncio.run(main_async(args, privkeys, names, profile))
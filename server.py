@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 import base64
 import datetime
+import heapq
+import itertools
 import json
+import math
+import queue
 import sqlite3
+import struct
+import threading
+import time
+from collections import OrderedDict
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -16,33 +24,72 @@ limiter = Limiter(
     app=app, key_func=get_remote_address, default_limits=["100 per 5 minutes"]
 )
 
+# reports_detail 表的字段，也是上报接口的必需字段
+REPORT_FIELDS = ['id_short', 'timestamp', 'isodatetime', 'datePublished',
+                 'latitude', 'longitude', 'payload', 'id', 'status', 'statusCode']
 
-def format_datetime(dateTime, options=None):
-    """Format datetime to ISO format"""
-    if options is None:
-        options = {
-            "year": "numeric",
-            "month": "2-digit",
-            "day": "2-digit",
-            "hour": "2-digit",
-            "minute": "2-digit",
-            "second": "2-digit",
-            "hour12": False,
-        }
+ID_COLUMN = REPORT_FIELDS.index('id')
 
-    dt = datetime.datetime.fromisoformat(dateTime.replace("Z", "+00:00"))
-    formatted = dt.strftime("%Y-%m-%dT%H:%M:%S")
-    return formatted
+# 批量上报接口单次允许的最大报告数
+MAX_BATCH_SIZE = 1000
+
+# 数据库连接池：WAL 模式下读写互不阻塞，等锁最多 DB_BUSY_TIMEOUT 毫秒
+DB_PATH = "./reports.db"
+DB_BUSY_TIMEOUT = 5000
+DB_POOL_SIZE = 8
+DB_PRAGMAS = {
+    "synchronous": "NORMAL",   # WAL 下只在检查点时 fsync，进程崩溃不丢数据
+    "cache_size": -16000,      # 每个连接 16MB 页缓存
+    "mmap_size": 268435456,    # 256MB 内存映射读
+    "temp_store": "MEMORY",
+}
+
+# 写入线程分组提交：攒够 INGEST_GROUP_SIZE 条或等待 INGEST_GROUP_DELAY 秒后提交一次，
+# 写入连接使用 synchronous=FULL，请求返回成功时数据已经落盘
+INGEST_GROUP_SIZE = 5000
+INGEST_GROUP_DELAY = 0.005
+INGEST_TIMEOUT = 30
+
+# /query 的流式响应格式：ndjson 每行一条报告，json-stream 与默认格式相同的 {"data": [...]}，
+# 两者都按 STREAM_CHUNK_ROWS 条一块边查边发送。响应头发出后无法再改状态码，因此每种格式
+# 都以结束记录收尾：完整时为 {"complete": true}，中途出错时为 {"error": ...}，
+# 没有结束记录说明连接被截断
+STREAM_FORMATS = {"ndjson": "application/x-ndjson", "json-stream": "application/json",
+                  "columnar": "application/octet-stream"}
+STREAM_CHUNK_ROWS = 500
 
+# columnar 格式可选的字段，默认只返回绘制轨迹需要的时间和坐标
+COLUMNAR_FIELDS = ("timestamp", "latitude", "longitude", "status", "id")
+COLUMNAR_DEFAULT_FIELDS = ["timestamp", "latitude", "longitude"]
+COLUMNAR_MAGIC = b"NJC1"
+COORDINATE_SCALE = 1000000  # 坐标以微度（int32）传输
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
 
-def utc_to_iso_format(dateTimeRange):
-    """Convert UTC datetime range to local ISO format"""
-    if not dateTimeRange or "start" not in dateTimeRange or "end" not in dateTimeRange:
-        return {"startLocalISO": None, "endLocalISO": None}
+# 轨迹简化：zoom 换算为该缩放级别下一个像素对应的米数作为容差，结果按 (设备, 时间范围, 级别) 缓存
+SIMPLIFY_MAX_ZOOM = 22
+SIMPLIFY_CACHE_SIZE = 256
+METERS_PER_PIXEL_ZOOM0 = 156543.03392  # 256 像素瓦片在赤道处 zoom 0 的分辨率
 
-    startLocalISO = format_datetime(dateTimeRange["start"])
-    endLocalISO = format_datetime(dateTimeRange["end"])
-    return {"startLocalISO": startLocalISO, "endLocalISO": endLocalISO}
+# timerange 查询分页：按 (timestamp, id) 排序，游标为上一页最后一条报告的位置
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+
+def parse_utc_timestamp(dateTime):
+    """Convert an ISO datetime (or a unix timestamp) to a unix timestamp, naive values are UTC"""
+    if isinstance(dateTime, (int, float)):
+        return dateTime
+    dt = datetime.datetime.fromisoformat(dateTime.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+
+def utc_to_timestamp_range(dateTimeRange):
+    """Convert UTC datetime range to an inclusive integer timestamp range"""
+    start = math.ceil(parse_utc_timestamp(dateTimeRange["start"]))
+    end = math.floor(parse_utc_timestamp(dateTimeRange["end"]))
+    return start, end
 
 
 def decode_base64_payload(base64Payload):
@@ -61,13 +108,198 @@ def decode_base64_payload(base64Payload):
         raise ValueError("Invalid Base64 format")
 
 
-def get_db_connection():
-    """Get database connection"""
-    conn = sqlite3.connect("./reports.db")
+def open_db_connection(path=DB_PATH, busy_timeout=DB_BUSY_TIMEOUT, pragmas=DB_PRAGMAS):
+    """打开一个 WAL 模式的数据库连接"""
+    conn = sqlite3.connect(path, timeout=busy_timeout / 1000, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name}={value}")
     return conn
 
 
+class ConnectionPool:
+    """复用 sqlite 连接，避免每个请求重新打开数据库
+
+    空闲连接放在栈里，取用时由当前线程独占，close() 时回滚未提交的事务并归还；
+    空闲连接超过 size 个时直接关闭。
+    """
+
+    def __init__(self, path, size=DB_POOL_SIZE, busy_timeout=DB_BUSY_TIMEOUT, pragmas=DB_PRAGMAS):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.pragmas = pragmas
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        return open_db_connection(self.path, self.busy_timeout, self.pragmas)
+
+    def get(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        return PooledConnection(self, conn)
+
+    def put(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+class PooledConnection:
+    """连接池中的连接，close() 把连接归还给连接池而不是真正关闭"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.put(self._conn)
+            self._conn = None
+
+
+db_pool = ConnectionPool(DB_PATH)
+
+
+def get_db_connection():
+    """Get database connection"""
+    return db_pool.get()
+
+
+class IngestRequest:
+    """一次上报请求待写入的行，写入线程提交后通过 done 通知请求线程"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.error = None
+        self.done = threading.Event()
+
+
+class IngestWriter:
+    """唯一的写入线程，把多个上报请求合并到一个事务里提交
+
+    请求线程调用 write() 入队后等待，写入线程按条数或等待时间凑够一组后一次提交，
+    提交完成才让请求返回。整组提交失败时逐个请求单独重试，
+    一个请求出错不会影响同组的其他请求。
+    """
+
+    def __init__(self, path=DB_PATH, group_size=INGEST_GROUP_SIZE, group_delay=INGEST_GROUP_DELAY):
+        self.path = path
+        self.group_size = group_size
+        self.group_delay = group_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+                self._thread.start()
+
+    def write(self, rows, timeout=INGEST_TIMEOUT):
+        """写入 reports_detail 行，提交落盘后返回，失败时抛出 sqlite3.Error"""
+        self._start()
+        pending = IngestRequest(rows)
+        self._queue.put(pending)
+        if not pending.done.wait(timeout):
+            raise sqlite3.OperationalError("database is locked: ingest commit timed out")
+        if pending.error is not None:
+            raise pending.error
+
+    def _collect(self):
+        """阻塞取出第一个请求，再在 group_delay 内继续合并，最多 group_size 条"""
+        group = [self._queue.get()]
+        count = len(group[0].rows)
+        deadline = time.monotonic() + self.group_delay
+        while count < self.group_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    pending = self._queue.get(timeout=remaining)
+                else:
+                    pending = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            group.append(pending)
+            count += len(pending.rows)
+        return group
+
+    def _commit(self, conn, group):
+        cursor = conn.cursor()
+        try:
+            for pending in group:
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO reports_detail
+                    (id_short, timestamp, isodatetime, datePublished, latitude, longitude, payload, id, status, statusCode)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', pending.rows)
+                # 同一事务里更新每个 id 的最新位置，只接受不早于当前记录的报告
+                cursor.executemany('''
+                    INSERT INTO latest_position
+                    (id_short, timestamp, isodatetime, datePublished, latitude, longitude, payload, id, status, statusCode)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        id_short = excluded.id_short,
+                        timestamp = excluded.timestamp,
+                        isodatetime = excluded.isodatetime,
+                        datePublished = excluded.datePublished,
+                        latitude = excluded.latitude,
+                        longitude = excluded.longitude,
+                        payload = excluded.payload,
+                        status = excluded.status,
+                        statusCode = excluded.statusCode
+                    WHERE excluded.timestamp >= latest_position.timestamp
+                ''', pending.rows)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    def _run(self):
+        conn = open_db_connection(self.path, pragmas={**DB_PRAGMAS, "synchronous": "FULL"})
+        while True:
+            group = self._collect()
+            try:
+                self._commit(conn, group)
+            except sqlite3.Error as e:
+                print(f"分组提交失败，逐个重试: {e}")
+                for pending in group:
+                    try:
+                        self._commit(conn, [pending])
+                    except sqlite3.Error as e:
+                        pending.error = e
+            # 新报告可能改变已缓存的简化轨迹
+            track_cache.invalidate({row[ID_COLUMN] for pending in group
+                                    if pending.error is None for row in pending.rows})
+            for pending in group:
+                pending.done.set()
+
+
+ingest_writer = IngestWriter()
+
+
+def db_error_response(error):
+    """数据库错误响应：等锁超时返回 503 让客户端稍后重试，其余返回 500"""
+    print(f"数据库错误: {error}")
+    if isinstance(error, sqlite3.OperationalError) and "locked" in str(error):
+        response = jsonify({"error": f"Database busy: {str(error)}"})
+        response.headers["Retry-After"] = "1"
+        return response, 503
+    return jsonify({"error": f"Database error: {str(error)}"}), 500
+
+
 def init_database():
     """Initialize database with required tables"""
     conn = get_db_connection()
@@ -82,20 +314,83 @@ def init_database():
                         PRIMARY KEY (name, hashed_adv_key)
                     )''')
     
+    # reports_detail is clustered on (id, timestamp) (WITHOUT ROWID), so a time
+    # range of one id is a single covering index range scan already in timestamp order.
+    # Older databases with a rowid table are migrated once.
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='reports_detail'")
+    row = cursor.fetchone()
+    migrate = row is not None and 'WITHOUT ROWID' not in row['sql'].upper()
+    if migrate:
+        print("Migrating reports_detail to a WITHOUT ROWID table...")
+        conn.commit()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("ALTER TABLE reports_detail RENAME TO reports_detail_rowid")
+
     # Create reports_detail table if not exists
     cursor.execute('''CREATE TABLE IF NOT EXISTS reports_detail (
-                        id_short TEXT, 
+                        id_short TEXT,
                         timestamp INTEGER,
                         isodatetime TEXT,
                         datePublished INTEGER,
                         latitude REAL,
                         longitude REAL,
-                        payload TEXT, 
-                        id TEXT, 
+                        payload TEXT,
+                        id TEXT,
                         status INTEGER,
-                        statusCode INTEGER, 
+                        statusCode INTEGER,
                         PRIMARY KEY(id, timestamp)
+                     ) WITHOUT ROWID''')
+
+    if migrate:
+        cursor.execute('''
+            INSERT OR REPLACE INTO reports_detail
+            (id_short, timestamp, isodatetime, datePublished, latitude, longitude, payload, id, status, statusCode)
+            SELECT id_short, timestamp, isodatetime, datePublished, latitude, longitude, payload, id, status, statusCode
+            FROM reports_detail_rowid
+        ''')
+        cursor.execute("DROP TABLE reports_detail_rowid")
+        conn.commit()
+
+    # Create latest_position table: the newest report of each id, maintained on ingest
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='latest_position'")
+    backfill = cursor.fetchone() is None
+    cursor.execute('''CREATE TABLE IF NOT EXISTS latest_position (
+                        id_short TEXT,
+                        timestamp INTEGER,
+                        isodatetime TEXT,
+                        datePublished INTEGER,
+                        latitude REAL,
+                        longitude REAL,
+                        payload TEXT,
+                        id TEXT PRIMARY KEY,
+                        status INTEGER,
+                        statusCode INTEGER
                      )''')
+    if backfill:
+        # 首次创建时从已有数据回填，MAX() 聚合时其余列取自最新那一行
+        cursor.execute('''
+            INSERT INTO latest_position
+            (id_short, timestamp, isodatetime, datePublished, latitude, longitude, payload, id, status, statusCode)
+            SELECT id_short, MAX(timestamp), isodatetime, datePublished, latitude, longitude, payload, id, status, statusCode
+            FROM reports_detail
+            GROUP BY id
+        ''')
+
+    # Secondary indexes for /query lookups
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_keymap_private_key ON keyMap (private_key)")
+    # timerange queries use the (id, timestamp) primary key instead of isodatetime
+    cursor.execute("DROP INDEX IF EXISTS idx_reports_id_isodatetime")
+
+    # Create fetch_leases / fetch_workers tables for coordinating fetcher workers
+    cursor.execute('''CREATE TABLE IF NOT EXISTS fetch_leases (
+                        shard INTEGER PRIMARY KEY,
+                        worker TEXT,
+                        expires INTEGER
+                    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS fetch_workers (
+                        worker TEXT PRIMARY KEY,
+                        expires INTEGER
+                    )''')
     
     conn.commit()
     conn.close()
@@ -110,50 +405,161 @@ def receive_report():
             return jsonify({"error": "Invalid request format, expected JSON"}), 400
         
         # 验证必需字段
-        required_fields = ['id_short', 'timestamp', 'isodatetime', 'datePublished', 
-                          'latitude', 'longitude', 'payload', 'id', 'status', 'statusCode']
-        
-        for field in required_fields:
+        for field in REPORT_FIELDS:
             if field not in request.json:
                 return jsonify({"error": f"Missing required field: {field}"}), 400
         
+        # 交给写入线程，与其他请求合并提交
+        try:
+            ingest_writer.write([tuple(request.json[field] for field in REPORT_FIELDS)])
+            print(f"成功插入报告: {request.json['id_short']} at {request.json['isodatetime']}")
+
+            return jsonify({"success": True, "message": "Report received and stored"}), 200
+
+        except sqlite3.Error as e:
+            return db_error_response(e)
+
+    except Exception as err:
+        print(f"处理报告时发生错误: {err}")
+        return jsonify({"error": str(err)}), 500
+
+
+@app.route("/api/reports/batch", methods=["POST"])
+@limiter.limit("200 per 5 minutes")
+def receive_reports_batch():
+    """批量接收报告数据，在一个事务中写入数据库并返回每条的处理结果"""
+    try:
+        reports = request.get_json(silent=True)
+        if not isinstance(reports, list):
+            return jsonify({"error": "Invalid request format, expected JSON array"}), 400
+
+        if len(reports) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"Too many reports, at most {MAX_BATCH_SIZE} per request"}), 413
+
+        # 批量验证，只写入合法的报告
+        results = []
+        rows = []
+        for index, report in enumerate(reports):
+            if not isinstance(report, dict):
+                results.append({"index": index, "success": False, "error": "Invalid report, expected JSON object"})
+                continue
+            missing = [field for field in REPORT_FIELDS if field not in report]
+            if missing:
+                results.append({"index": index, "success": False, "error": f"Missing required field: {missing[0]}"})
+                continue
+            results.append({"index": index, "success": True})
+            rows.append(tuple(report[field] for field in REPORT_FIELDS))
+
+        if rows:
+            # 整批作为一个请求交给写入线程，保证同批报告在同一个事务里
+            try:
+                ingest_writer.write(rows)
+            except sqlite3.Error as e:
+                return db_error_response(e)
+
+        print(f"成功批量插入报告: {len(rows)}/{len(reports)}")
+        return jsonify({
+            "success": True,
+            "stored": len(rows),
+            "failed": len(reports) - len(rows),
+            "results": results
+        }), 200
+
+    except Exception as err:
+        print(f"批量处理报告时发生错误: {err}")
+        return jsonify({"error": str(err)}), 500
+
+
+@app.route("/api/leases/acquire", methods=["POST"])
+@limiter.limit("100 per 5 minutes")
+def acquire_leases():
+    """租用或续租密钥分片：每个在线 worker 最多持有 ceil(分片数 / worker 数) 个分片"""
+    try:
+        if not request.json:
+            return jsonify({"error": "Invalid request format, expected JSON"}), 400
+
+        for field in ['worker', 'shard_count', 'ttl']:
+            if field not in request.json:
+                return jsonify({"error": f"Missing required field: {field}"}), 400
+
+        worker = request.json['worker']
+        shard_count = int(request.json['shard_count'])
+        ttl = int(request.json['ttl'])
+        now = int(time.time())
+
         conn = get_db_connection()
         cursor = conn.cursor()
-        
-        # 插入数据到数据库
         try:
-            cursor.execute('''
-                INSERT OR REPLACE INTO reports_detail 
-                (id_short, timestamp, isodatetime, datePublished, latitude, longitude, payload, id, status, statusCode) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                request.json['id_short'],
-                request.json['timestamp'],
-                request.json['isodatetime'],
-                request.json['datePublished'],
-                request.json['latitude'],
-                request.json['longitude'],
-                request.json['payload'],
-                request.json['id'],
-                request.json['status'],
-                request.json['statusCode']
-            ))
-            
+            # 立即加写锁，避免两个 worker 同时拿到同一个分片
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("DELETE FROM fetch_workers WHERE expires < ?", (now,))
+            cursor.execute("INSERT OR REPLACE INTO fetch_workers (worker, expires) VALUES (?, ?)",
+                           (worker, now + ttl))
+            cursor.execute("SELECT COUNT(*) FROM fetch_workers")
+            workers = cursor.fetchone()[0]
+            want = math.ceil(shard_count / workers)
+
+            cursor.execute(
+                "SELECT shard FROM fetch_leases WHERE worker = ? AND expires >= ? AND shard < ? ORDER BY shard",
+                (worker, now, shard_count))
+            held = [row["shard"] for row in cursor.fetchall()]
+
+            # 有新 worker 加入时让出多余的分片
+            released = held[want:]
+            held = held[:want]
+            cursor.executemany("DELETE FROM fetch_leases WHERE shard = ?", [(shard,) for shard in released])
+
+            cursor.execute("SELECT shard FROM fetch_leases WHERE expires >= ?", (now,))
+            taken = {row["shard"] for row in cursor.fetchall()}
+            free = [shard for shard in range(shard_count) if shard not in taken]
+            # 不接管其他 worker 仍持有的分片：它们在下次续租时才知道分片已让出，
+            # 期间两边会重复抓取。超出配额的 worker 续租时自行让出，新 worker 随后领取
+            held += free[:max(0, want - len(held))]
+
+            cursor.executemany(
+                "INSERT OR REPLACE INTO fetch_leases (shard, worker, expires) VALUES (?, ?, ?)",
+                [(shard, worker, now + ttl) for shard in held])
             conn.commit()
-            print(f"成功插入报告: {request.json['id_short']} at {request.json['isodatetime']}")
-            
-            return jsonify({"success": True, "message": "Report received and stored"}), 200
-            
+
+            return jsonify({"success": True, "shards": sorted(held), "workers": workers}), 200
+
         except sqlite3.Error as e:
             conn.rollback()
-            print(f"数据库错误: {e}")
-            return jsonify({"error": f"Database error: {str(e)}"}), 500
-        
+            return db_error_response(e)
+
         finally:
             conn.close()
-            
+
     except Exception as err:
-        print(f"处理报告时发生错误: {err}")
+        print(f"租用分片时发生错误: {err}")
+        return jsonify({"error": str(err)}), 500
+
+
+@app.route("/api/leases/release", methods=["POST"])
+@limiter.limit("100 per 5 minutes")
+def release_leases():
+    """释放 worker 持有的全部分片"""
+    try:
+        if not request.json or 'worker' not in request.json:
+            return jsonify({"error": "Missing required field: worker"}), 400
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("DELETE FROM fetch_leases WHERE worker = ?", (request.json['worker'],))
+            cursor.execute("DELETE FROM fetch_workers WHERE worker = ?", (request.json['worker'],))
+            conn.commit()
+            return jsonify({"success": True}), 200
+
+        except sqlite3.Error as e:
+            conn.rollback()
+            return db_error_response(e)
+
+        finally:
+            conn.close()
+
+    except Exception as err:
+        print(f"释放分片时发生错误: {err}")
         return jsonify({"error": str(err)}), 500
 
 
@@ -195,8 +601,7 @@ def update_keymap():
             
         except sqlite3.Error as e:
             conn.rollback()
-            print(f"数据库错误: {e}")
-            return jsonify({"error": f"Database error: {str(e)}"}), 500
+            return db_error_response(e)
         
         finally:
             conn.close()
@@ -206,6 +611,331 @@ def update_keymap():
         return jsonify({"error": str(err)}), 500
 
 
+def iter_reports_by_time(conn, ids, start, end, after=None, limit=None):
+    """按 (timestamp, id) 升序返回多个 id 在 [start, end] 内的报告
+
+    每个 id 在 (id, timestamp) 主键上单独做一次范围扫描，结果本身已按时间排序，
+    再在内存中归并，不需要对整个结果集排序。after 为分页游标 (timestamp, id)，
+    只返回排在它之后的报告；limit 限制每个 id 最多读取的条数。
+    """
+    cursors = []
+    for id in dict.fromkeys(ids):
+        low = start
+        if after is not None:
+            # 同一时间戳下 id 更大的报告排在游标之后
+            after_timestamp, after_id = after
+            low = max(start, after_timestamp if id > after_id else after_timestamp + 1)
+        cursors.append(conn.execute("""
+            SELECT *
+            FROM reports_detail
+            WHERE id = ? AND timestamp BETWEEN ? AND ?
+            ORDER BY timestamp
+            LIMIT ?
+        """, (id, low, end, -1 if limit is None else limit)))
+    return heapq.merge(*cursors, key=lambda row: (row["timestamp"], row["id"]))
+
+
+def simplify_track(rows, tolerance):
+    """Douglas-Peucker 简化一条按时间排序的轨迹，tolerance 单位为米，保留首尾点"""
+    if len(rows) <= 2 or tolerance <= 0:
+        return list(rows)
+
+    # 以轨迹平均纬度做等距投影，换算成平面米坐标
+    mean_lat = sum(row["latitude"] for row in rows) / len(rows)
+    kx = 111320.0 * math.cos(math.radians(mean_lat))
+    ky = 110540.0
+    points = [(row["longitude"] * kx, row["latitude"] * ky) for row in rows]
+
+    keep = [False] * len(rows)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(rows) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first], points[last]
+        dx, dy = x2 - x1, y2 - y1
+        length = math.hypot(dx, dy)
+        max_distance, index = -1.0, None
+        for i in range(first + 1, last):
+            x, y = points[i]
+            if length == 0:
+                distance = math.hypot(x - x1, y - y1)
+            else:
+                distance = abs(dy * (x - x1) - dx * (y - y1)) / length
+            if distance > max_distance:
+                max_distance, index = distance, i
+        if index is not None and max_distance > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [row for row, kept in zip(rows, keep) if kept]
+
+
+def simplify_tolerance(level, rows):
+    """简化级别换算为容差（米），zoom 按轨迹所在纬度的像素分辨率计算"""
+    kind, value = level
+    if kind == "tolerance":
+        return value
+    if not rows:
+        return 0
+    mean_lat = sum(row["latitude"] for row in rows) / len(rows)
+    return METERS_PER_PIXEL_ZOOM0 * math.cos(math.radians(mean_lat)) / (2 ** value)
+
+
+def parse_simplify(simplify):
+    """解析请求中的 simplify 参数：{"zoom": 0-22} 或 {"tolerance": 米}，返回 (类型, 值)"""
+    if not isinstance(simplify, dict) or len(simplify) != 1:
+        raise ValueError("Invalid simplify, expected {zoom: int} or {tolerance: meters}")
+    if "zoom" in simplify:
+        zoom = simplify["zoom"]
+        if isinstance(zoom, bool) or not isinstance(zoom, int) or not 0 <= zoom <= SIMPLIFY_MAX_ZOOM:
+            raise ValueError(f"Invalid zoom, expected 0-{SIMPLIFY_MAX_ZOOM}")
+        return ("zoom", zoom)
+    tolerance = simplify.get("tolerance")
+    if isinstance(tolerance, bool) or not isinstance(tolerance, (int, float)) or tolerance <= 0:
+        raise ValueError("Invalid tolerance, expected a positive number of meters")
+    return ("tolerance", tolerance)
+
+
+class TrackCache:
+    """简化后轨迹的 LRU 缓存，键为 (设备, 该设备查询的 id, start, end, level)
+
+    一个设备的多个滚动密钥合成一条轨迹后再简化，因此缓存和失效都以设备为单位：
+    读取轨迹前登记 id 所属的设备，写入线程提交新报告后按 id 找到设备并失效。
+    每个设备有一个代数，读取轨迹期间有新写入时不缓存这次的结果，避免缓存过期数据。
+    """
+
+    def __init__(self, maxsize=SIMPLIFY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._tracks = OrderedDict()
+        self._generations = {}
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def generation(self, device, ids):
+        with self._lock:
+            for id in ids:
+                self._devices[id] = device
+            return self._generations.get(device, 0)
+
+    def get(self, key):
+        with self._lock:
+            track = self._tracks.get(key)
+            if track is not None:
+                self._tracks.move_to_end(key)
+            return track
+
+    def put(self, key, track, generation):
+        with self._lock:
+            if self._generations.get(key[0], 0) != generation:
+                return
+            self._tracks[key] = track
+            if len(self._tracks) > self.maxsize:
+                self._tracks.popitem(last=False)
+
+    def invalidate(self, ids):
+        with self._lock:
+            devices = {self._devices[id] for id in ids if id in self._devices}
+            for device in devices:
+                self._generations[device] = self._generations.get(device, 0) + 1
+            for key in [key for key in self._tracks if key[0] in devices]:
+                del self._tracks[key]
+
+
+track_cache = TrackCache()
+
+
+def simplified_track(conn, device, ids, start, end, level):
+    """把一个设备的多个 id 在 [start, end] 内的报告按时间合成一条轨迹并简化，结果按设备缓存"""
+    ids = tuple(sorted(set(ids)))
+    key = (device, ids, start, end, level)
+    track = track_cache.get(key)
+    if track is not None:
+        return track
+    generation = track_cache.generation(device, ids)
+    rows = [dict(row) for row in iter_reports_by_time(conn, ids, start, end)]
+    track = simplify_track(rows, simplify_tolerance(level, rows))
+    track_cache.put(key, track, generation)
+    return track
+
+
+def encode_cursor(row):
+    """分页游标：报告的 (timestamp, id)，对客户端不透明"""
+    return base64.urlsafe_b64encode(json.dumps([row["timestamp"], row["id"]]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(timestamp, int) or not isinstance(id, str):
+        raise ValueError("Invalid cursor")
+    return timestamp, id
+
+
+class ReportPage:
+    """最多 page_size 条报告的一页，遍历完后 next_cursor 为下一页的游标，没有下一页时为 None"""
+
+    def __init__(self, rows, page_size):
+        self.rows = rows
+        self.page_size = page_size
+        self.next_cursor = None
+
+    def __iter__(self):
+        last = None
+        for count, row in enumerate(self.rows):
+            # 多读一条，确认还有下一页
+            if count == self.page_size:
+                self.next_cursor = encode_cursor(last)
+                return
+            last = row
+            yield row
+
+
+class ColumnarEncoder:
+    """紧凑的二进制列式编码，所有整数均为小端
+
+    magic "NJC1"
+    u32 头部长度 + 头部 JSON {"fields", "ids", "timestampBase", "scale"}
+    若干数据块：u32 行数，随后按 fields 顺序每列 行数 个 int32
+    u32 0 表示数据块结束
+    u32 尾部长度 + 尾部 JSON：完整时 {"complete": true, "nextCursor", "skipped"}，出错时 {"error"}
+
+    timestamp 为相对上一行的差值（第一行相对 timestampBase），latitude/longitude
+    为微度坐标相对上一行的差值（第一行相对 0），差值跨数据块连续；
+    status 为原值，id 为在头部 ids 中的序号。
+    写入接口不检查类型，所选字段缺失（如没有坐标）、不是数值或超出 int32 的行
+    不编码，数量记在尾部的 skipped 中。
+    """
+
+    DELTA_FIELDS = ("timestamp", "latitude", "longitude")
+
+    def __init__(self, fields, ids, timestamp_base=0):
+        self.fields = fields
+        self.ids = list(ids)
+        self.id_index = {id: i for i, id in enumerate(self.ids)}
+        self.timestamp_base = timestamp_base
+        self.previous = {"timestamp": timestamp_base, "latitude": 0, "longitude": 0}
+        self.skipped = 0
+
+    @staticmethod
+    def _json_section(data):
+        encoded = json.dumps(data).encode()
+        return struct.pack("<I", len(encoded)) + encoded
+
+    def header(self):
+        return COLUMNAR_MAGIC + self._json_section({
+            "fields": self.fields,
+            "ids": self.ids,
+            "timestampBase": self.timestamp_base,
+            "scale": COORDINATE_SCALE,
+        })
+
+    def _columns(self, rows, previous):
+        """把若干行按列转换为 int32，返回各列；有无法编码的值时抛出 ValueError 等异常"""
+        columns = []
+        for field in self.fields:
+            if field == "id":
+                values = [self.id_index[row["id"]] for row in rows]
+            elif field == "status":
+                values = [int(row["status"]) for row in rows]
+            elif field == "timestamp":
+                values = [int(row["timestamp"]) for row in rows]
+            else:
+                values = [round(float(row[field]) * COORDINATE_SCALE) for row in rows]
+            if field in self.DELTA_FIELDS:
+                deltas = []
+                last = previous[field]
+                for value in values:
+                    deltas.append(value - last)
+                    last = value
+                previous[field] = last
+                values = deltas
+            if values and not (INT32_MIN <= min(values) and max(values) <= INT32_MAX):
+                raise ValueError(f"{field} out of int32 range")
+            columns.append(values)
+        return columns
+
+    def block(self, rows):
+        previous = dict(self.previous)
+        try:
+            columns = self._columns(rows, previous)
+        except (TypeError, ValueError, OverflowError, KeyError):
+            # 整块有无法编码的行时逐行编码，跳过这些行
+            encoded = []
+            previous = dict(self.previous)
+            for row in rows:
+                attempt = dict(previous)
+                try:
+                    encoded.append([column[0] for column in self._columns([row], attempt)])
+                    previous = attempt
+                except (TypeError, ValueError, OverflowError, KeyError):
+                    self.skipped += 1
+            columns = [list(column) for column in zip(*encoded)]
+        self.previous = previous
+        count = len(columns[0]) if columns else 0
+        if not count:
+            # 行数为 0 的块表示数据结束，整块都被跳过时不发送
+            return b""
+        parts = [struct.pack("<I", count)]
+        for column in columns:
+            parts.append(struct.pack(f"<{count}i", *column))
+        return b"".join(parts)
+
+    def trailer(self, end):
+        if "complete" in end:
+            end = dict(end, skipped=self.skipped)
+        return struct.pack("<I", 0) + self._json_section(end)
+
+
+def stream_rows(conn, rows, response_format, columnar=None):
+    """把查询结果逐块编码为流式响应，内存占用与结果集大小无关，发送结束后归还连接
+
+    每个数据块完整编码后才发送，出错时停在块的边界上，再追加结束记录说明原因。
+    """
+    def generate():
+        try:
+            if response_format == "json-stream":
+                yield '{"data":['
+            elif response_format == "columnar":
+                yield columnar.header()
+            separator = ""
+            remaining = iter(rows)
+            while True:
+                chunk = list(itertools.islice(remaining, STREAM_CHUNK_ROWS))
+                if not chunk:
+                    break
+                if response_format == "ndjson":
+                    yield "".join(json.dumps(dict(row)) + "\n" for row in chunk)
+                elif response_format == "columnar":
+                    yield columnar.block(chunk)
+                else:
+                    yield separator + ",".join(json.dumps(dict(row)) for row in chunk)
+                    separator = ","
+            end = {"complete": True}
+            # 分页时在结束记录中附上下一页游标
+            if isinstance(rows, ReportPage):
+                end["nextCursor"] = rows.next_cursor
+        except Exception as e:
+            # 响应头已经发出，只能在流末尾报告错误
+            print(f"流式响应中断: {e}")
+            if isinstance(e, sqlite3.Error):
+                end = {"error": f"Database error: {str(e)}"}
+            else:
+                end = {"error": str(e)}
+        finally:
+            conn.close()
+
+        if response_format == "json-stream":
+            yield "]," + ",".join(f"{json.dumps(key)}:{json.dumps(value)}" for key, value in end.items()) + "}"
+        elif response_format == "columnar":
+            yield columnar.trailer(end)
+        else:
+            yield json.dumps(end) + "\n"
+
+    return Response(generate(), mimetype=STREAM_FORMATS[response_format])
+
+
 @app.route("/query", methods=["POST"])
 @limiter.limit("100 per 5 minutes")
 def query_reports():
@@ -221,16 +951,54 @@ def query_reports():
         id_array = decoded_data.get("idArray", [])
         date_time_range = decoded_data.get("dateTimeRange")
         mode = decoded_data.get("mode")
+        response_format = decoded_data.get("format", "json")
 
         if not id_array or not mode:
             return jsonify({"error": "Invalid request body"}), 400
 
+        if response_format != "json" and response_format not in STREAM_FORMATS:
+            return jsonify({"error": "Invalid format"}), 400
+
+        fields = decoded_data.get("fields", COLUMNAR_DEFAULT_FIELDS)
+        if response_format == "columnar" and (
+            not isinstance(fields, list) or not fields
+            or any(field not in COLUMNAR_FIELDS for field in fields)
+        ):
+            return jsonify({"error": f"Invalid fields, expected a list of {', '.join(COLUMNAR_FIELDS)}"}), 400
+
+        # 可选分页（仅 timerange）：pageSize 条一页，cursor 为上一页返回的 nextCursor
+        page_size = decoded_data.get("pageSize")
+        cursor_token = decoded_data.get("cursor")
+        after = None
+        if page_size is not None or cursor_token is not None:
+            if mode != "timerange":
+                return jsonify({"error": "pageSize and cursor are only supported in timerange mode"}), 400
+            page_size = DEFAULT_PAGE_SIZE if page_size is None else page_size
+            if not isinstance(page_size, int) or not 1 <= page_size <= MAX_PAGE_SIZE:
+                return jsonify({"error": f"Invalid pageSize, expected 1-{MAX_PAGE_SIZE}"}), 400
+            try:
+                after = decode_cursor(cursor_token) if cursor_token is not None else None
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
+        # 可选轨迹简化（仅 timerange），简化结果是整条轨迹，不能分页
+        simplify = decoded_data.get("simplify")
+        if simplify is not None:
+            if mode != "timerange":
+                return jsonify({"error": "simplify is only supported in timerange mode"}), 400
+            if page_size is not None:
+                return jsonify({"error": "simplify cannot be combined with pageSize or cursor"}), 400
+            try:
+                simplify = parse_simplify(simplify)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
         conn = get_db_connection()
         cursor = conn.cursor()
 
         # Step 1: Query keyMap table to get hashed_adv_key for each private_key
         key_map_query = """
-            SELECT private_key, hashed_adv_key
+            SELECT name, private_key, hashed_adv_key
             FROM keyMap 
             WHERE private_key IN ({})
         """.format(",".join(["?" for _ in id_array]))
@@ -241,10 +1009,13 @@ def query_reports():
         # Build bidirectional mapping
         priv_to_hashed = {}
         hashed_to_priv = {}
+        # 设备名 -> 该设备的 hashed_adv_key，滚动密钥的设备有多个
+        device_keys = {}
 
         for row in key_map_rows:
             priv_to_hashed[row["private_key"]] = row["hashed_adv_key"]
             hashed_to_priv[row["hashed_adv_key"]] = row["private_key"]
+            device_keys.setdefault(row["name"], []).append(row["hashed_adv_key"])
 
         # Get hashed_adv_keys for query
         hashed_adv_keys = list(priv_to_hashed.values())
@@ -254,31 +1025,14 @@ def query_reports():
 
         # Step 2: Query reports_detail table based on mode
         if mode == "realtime":
+            # latest_position 在写入时维护，按主键直接取每个 id 的最新报告
             query = """
-                SELECT t.*
-                FROM reports_detail t
-                JOIN (
-                    SELECT id, MAX(isodatetime) AS latest_isodatetime
-                    FROM reports_detail
-                    WHERE id IN ({})
-                    GROUP BY id
-                ) sub
-                ON t.id = sub.id AND t.isodatetime = sub.latest_isodatetime
-                WHERE t.id IN ({})
-            """.format(
-                ",".join(["?" for _ in hashed_adv_keys]),
-                ",".join(["?" for _ in hashed_adv_keys]),
-            )
-
-            params = hashed_adv_keys + hashed_adv_keys
-            cursor.execute(query, params)
-            rows = cursor.fetchall()
-
-            # Convert rows to dictionaries
-            result = [dict(row) for row in rows]
+                SELECT *
+                FROM latest_position
+                WHERE id IN ({})
+            """.format(",".join(["?" for _ in hashed_adv_keys]))
 
-            conn.close()
-            return jsonify({"data": result})
+            rows = cursor.execute(query, hashed_adv_keys)
 
         elif mode == "timerange":
             if (
@@ -289,31 +1043,48 @@ def query_reports():
                 conn.close()
                 return jsonify({"error": "Invalid dateTimeRange"}), 400
 
-            iso_format = utc_to_iso_format(date_time_range)
-            query = """
-                SELECT * 
-                FROM reports_detail 
-                WHERE id IN ({}) 
-                AND isodatetime BETWEEN ? AND ?
-            """.format(",".join(["?" for _ in hashed_adv_keys]))
-
-            params = hashed_adv_keys + [
-                iso_format["startLocalISO"],
-                iso_format["endLocalISO"],
-            ]
-            cursor.execute(query, params)
-            rows = cursor.fetchall()
-
-            # Convert rows to dictionaries
-            result = [dict(row) for row in rows]
+            try:
+                start, end = utc_to_timestamp_range(date_time_range)
+            except (TypeError, ValueError):
+                conn.close()
+                return jsonify({"error": "Invalid dateTimeRange"}), 400
 
-            conn.close()
-            return jsonify({"data": result})
+            if simplify is not None:
+                # 每个设备的所有密钥合成一条轨迹单独简化，再按 (timestamp, id) 归并
+                rows = heapq.merge(
+                    *(simplified_track(conn, device, ids, start, end, simplify)
+                      for device, ids in device_keys.items()),
+                    key=lambda row: (row["timestamp"], row["id"]))
+            elif page_size is None:
+                rows = iter_reports_by_time(conn, hashed_adv_keys, start, end)
+            else:
+                # 每个 id 最多需要 page_size + 1 条，即可确定本页并判断是否还有下一页
+                rows = ReportPage(iter_reports_by_time(conn, hashed_adv_keys, start, end,
+                                                       after, page_size + 1), page_size)
 
         else:
             conn.close()
             return jsonify({"error": "Invalid mode"}), 400
 
+        # 流式格式边查边发送，连接在响应发送完后归还
+        if response_format == "columnar":
+            # timerange 的时间差值从查询起点开始，realtime 从 0 开始
+            timestamp_base = max(start, 0) if mode == "timerange" else 0
+            columnar = ColumnarEncoder(fields, dict.fromkeys(hashed_adv_keys), timestamp_base)
+            return stream_rows(conn, rows, response_format, columnar)
+        if response_format in STREAM_FORMATS:
+            return stream_rows(conn, rows, response_format)
+
+        # Convert rows to dictionaries
+        result = [dict(row) for row in rows]
+
+        conn.close()
+        if isinstance(rows, ReportPage):
+            return jsonify({"data": result, "nextCursor": rows.next_cursor})
+        return jsonify({"data": result})
+
+    except sqlite3.OperationalError as e:
+        return db_error_response(e)
     except Exception as err:
         return jsonify({"error": str(err)}), 500
 